@@ -0,0 +1,207 @@
+import time
+import multiprocessing
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from src.dataset.position import PositionDataset
+from src.model.ffm import FFM
+from src.model.layer import CompressedInteractionNetwork, FieldAwareFactorizationMachine
+from main import get_data_loader
+
+_cache = None  # inherited by the forked benchmark workers, never pickled
+
+
+def lookup_worker(args):
+    indices, batch_size = args
+    start = time.time()
+    for i in range(0, len(indices), batch_size):
+        _cache.read(indices[i:i+batch_size])
+    return len(indices)/(time.time() - start)
+
+
+def bench_lookup(dataset, workers, lookups, batch_size, order, seed=0):
+    """
+    Every worker reads `lookups` samples from the cache, report lookups/sec per worker.
+    """
+    global _cache
+    _cache = dataset.cache
+    rng = np.random.RandomState(seed)
+    if order == 'random':
+        indices = [rng.randint(0, len(dataset), lookups) for _ in range(workers)]
+    else:
+        indices = [np.arange(s, min(s + lookups, len(dataset))) for s in rng.randint(0, max(1, len(dataset) - lookups), workers)]
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        rates = pool.map(lookup_worker, [(idx, batch_size) for idx in indices])
+    for i, rate in enumerate(rates):
+        print('worker:%d\tlookups/sec:%.1f'%(i, rate))
+    print('total\tlookups/sec:%.1f'%sum(rates))
+
+
+def bench_loader(dataset, batch_size, workers, batches):
+    """
+    Iterate the training loader for `batches` batches, report contexts/sec and rows/sec.
+    """
+    loader = get_data_loader(dataset, batch_size, True, workers)
+    contexts, rows = 0, 0
+    start = time.time()
+    for i, batch in enumerate(loader):
+        contexts += batch.target.shape[0]//dataset.pos_num  # read_flag 0, pos_num rows per context
+        rows += batch.target.shape[0]
+        if i + 1 == batches:
+            break
+    sec = time.time() - start
+    print('workers:%d\tcontexts/sec:%.1f\trows/sec:%.1f'%(workers, contexts/sec, rows/sec))
+
+
+def bench_ffm(embed_dims, batch_size, input_dims, ctx_nnz, item_nnz, pos_num, iters, sparse, seed=0):
+    """
+    Forward+backward of FFM with the unfused and the fused (layer.bag_dot) interaction on cpu, synthetic
+    dedup_ctx batches of batch_size contexts x pos_num items, report ms/iter and the max output difference.
+    """
+    g = torch.Generator().manual_seed(seed)
+    context = torch.randint(1, input_dims, (batch_size, ctx_nnz), generator=g)
+    context[:, ctx_nnz//2:][torch.rand(batch_size, ctx_nnz - ctx_nnz//2, generator=g) < 0.5] = 0  # ragged, padded contexts
+    value = torch.rand(batch_size, ctx_nnz, generator=g)*(context != 0).float()
+    item = torch.randint(1, input_dims, (batch_size*pos_num, item_nnz), generator=g)
+    ctx_rows = torch.arange(batch_size).repeat_interleave(pos_num)
+    pos = torch.zeros(batch_size*pos_num, 1, dtype=torch.long)
+    for k in embed_dims:
+        torch.manual_seed(seed)
+        model = FFM(input_dims, k, sparse=sparse)
+        outputs = list()
+        for fused in (False, True):
+            model.fused = fused
+            y = model(context, item, pos, value, ctx_rows)
+            y.sum().backward()  # warm up
+            model.zero_grad()
+            start = time.time()
+            for _ in range(iters):
+                y = model(context, item, pos, value, ctx_rows)
+                y.sum().backward()
+                model.zero_grad()
+            print('embed_dim:%d\tfused:%d\tms/iter:%.2f'%(k, fused, (time.time() - start)*1000/iters))
+            outputs.append(y.detach())
+        print('embed_dim:%d\tmax |fused - unfused|:%.3g'%(k, (outputs[0] - outputs[1]).abs().max().item()))
+
+
+def pair_loop(fafm, x):
+    """
+    The former FieldAwareFactorizationMachine.forward, a python loop over the field pairs of the same table.
+    """
+    x = x + x.new_tensor(fafm.offsets).unsqueeze(0)
+    xs = fafm.embedding(x).view(x.shape[0], fafm.num_fields, fafm.num_fields, fafm.embed_dim).unbind(2)  # xs[j]: the field j table
+    ix = list()
+    for i in range(fafm.num_fields - 1):
+        for j in range(i + 1, fafm.num_fields):
+            ix.append(xs[j][:, i] * xs[i][:, j])
+    return torch.stack(ix, dim=1)
+
+
+def bench_fieldffm(num_fields, embed_dim, batch_size, field_dim, iters, seed=0):
+    """
+    Forward+backward of layer.FieldAwareFactorizationMachine against the python pair loop on cpu for every
+    number of fields, report ms/iter of both and the max output difference.
+    """
+    for f in num_fields:
+        torch.manual_seed(seed)
+        fafm = FieldAwareFactorizationMachine([field_dim]*f, embed_dim)
+        x = torch.randint(0, field_dim, (batch_size, f))
+        outputs = list()
+        for name, forward in (('loop', lambda: pair_loop(fafm, x)), ('vectorized', lambda: fafm(x))):
+            forward().sum().backward()  # warm up
+            fafm.zero_grad()
+            start = time.time()
+            for _ in range(iters):
+                y = forward()
+                y.sum().backward()
+                fafm.zero_grad()
+            print('fields:%d\t%s\tms/iter:%.2f'%(f, name, (time.time() - start)*1000/iters))
+            outputs.append(y.detach())
+        print('fields:%d\tmax |vectorized - loop|:%.3g'%(f, (outputs[0] - outputs[1]).abs().max().item()))
+
+
+def cin_outer(cin, x):
+    """
+    The former CompressedInteractionNetwork.forward, conv_layers over the (batch_size, f0, fin, embed_dim) outer product.
+    """
+    xs = list()
+    x0, h = x.unsqueeze(2), x
+    for conv in cin.conv_layers:
+        x = x0 * h.unsqueeze(1)
+        batch_size, f0_dim, fin_dim, embed_dim = x.shape
+        x = F.relu(conv(x.view(batch_size, f0_dim * fin_dim, embed_dim)))
+        if cin.split_half:
+            x, h = torch.split(x, x.shape[1] // 2, dim=1)
+        else:
+            h = x
+        xs.append(x)
+    return cin.fc(torch.sum(torch.cat(xs, dim=1), 2))
+
+
+def bench_cin(num_fields, embed_dim, cross_layer_sizes, batch_size, field_chunk, iters, seed=0):
+    """
+    Forward+backward of layer.CompressedInteractionNetwork against the outer product formulation on cpu,
+    report ms/iter, the largest outer product the old formulation builds and the max output difference.
+    """
+    torch.manual_seed(seed)
+    cin = CompressedInteractionNetwork(num_fields, cross_layer_sizes, split_half=True, field_chunk=field_chunk)
+    x = torch.randn(batch_size, num_fields, embed_dim, requires_grad=True)
+    fin = [num_fields] + [k//2 for k in cross_layer_sizes[:-1]]
+    print('outer product MB per layer:%s'%','.join('%.1f'%(batch_size*num_fields*f*embed_dim*4/2**20) for f in fin))
+    outputs = list()
+    for name, forward in (('outer', lambda: cin_outer(cin, x)), ('chunked', lambda: cin(x))):
+        forward().sum().backward()  # warm up
+        start = time.time()
+        for _ in range(iters):
+            y = forward()
+            y.sum().backward()
+        print('%s\tfield_chunk:%d\tms/iter:%.2f'%(name, field_chunk, (time.time() - start)*1000/iters))
+        outputs.append(y.detach())
+    print('max |chunked - outer|:%.3g'%(outputs[0] - outputs[1]).abs().max().item())
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', default='lookup', help='"lookup", "loader", "ffm", "fieldffm" or "cin"')
+    parser.add_argument('--dataset_path', help='the path that contains item.svm and the data_prefix svm/cache')
+    parser.add_argument('--data_prefix', default='tr')
+    parser.add_argument('--cache_type', default='lmdb', help='"lmdb" or "mmap"')
+    parser.add_argument('--readahead', type=int, default=0)
+    parser.add_argument('--max_readers', type=int, default=126)
+    parser.add_argument('--workers', type=int, default=10, help='lookup processes, or DataLoader workers (0 for in_memory)')
+    parser.add_argument('--lookups', type=int, default=100000, help='samples read by every worker')
+    parser.add_argument('--batch_size', type=int, default=1, help='contexts per cache read (lookup) or per batch (loader, ffm)')
+    parser.add_argument('--order', default='random', help='"random" or "sequential"')
+    parser.add_argument('--in_memory', type=int, default=0)
+    parser.add_argument('--batches', type=int, default=1000, help='batches read by the loader task, timed iterations of the ffm task')
+    parser.add_argument('--embed_dims', default='16,32,64', help='ffm task: comma-separated embed_dim values, fieldffm task: the first one')
+    parser.add_argument('--fields', default='2,5,10,20,40', help='fieldffm task: comma-separated numbers of fields')
+    parser.add_argument('--field_dim', type=int, default=1000, help='fieldffm task: features per field')
+    parser.add_argument('--cross_layer_sizes', default='32,32,32', help='cin task: comma-separated cross layer sizes, --fields gives num_fields')
+    parser.add_argument('--field_chunk', type=int, default=1, help='cin task: x0 fields per step')
+    parser.add_argument('--input_dims', type=int, default=1000000, help='ffm task: embedding rows')
+    parser.add_argument('--ctx_nnz', type=int, default=64, help='ffm task: context features per context')
+    parser.add_argument('--item_nnz', type=int, default=8, help='ffm task: item features per item')
+    parser.add_argument('--pos_num', type=int, default=10, help='ffm task: items per context')
+    parser.add_argument('--sparse', type=int, default=1, help='ffm task: sparse embedding gradients')
+    args = parser.parse_args()
+
+    if args.task == 'ffm':  # synthetic batches, no dataset
+        bench_ffm([int(k) for k in args.embed_dims.split(',')], args.batch_size, args.input_dims, args.ctx_nnz, args.item_nnz, args.pos_num, args.batches, bool(args.sparse))
+    elif args.task == 'fieldffm':
+        bench_fieldffm([int(f) for f in args.fields.split(',')], int(args.embed_dims.split(',')[0]), args.batch_size, args.field_dim, args.batches)
+    elif args.task == 'cin':
+        bench_cin(int(args.fields.split(',')[-1]), int(args.embed_dims.split(',')[0]), [int(k) for k in args.cross_layer_sizes.split(',')], args.batch_size, args.field_chunk, args.batches)
+    elif args.task in ('lookup', 'loader'):
+        start = time.time()
+        dataset = PositionDataset(args.dataset_path, args.data_prefix, cache_type=args.cache_type, readahead=bool(args.readahead), max_readers=args.max_readers, in_memory=bool(args.in_memory))
+        print('in_memory:%d\tstartup sec:%.2f'%(args.in_memory, time.time() - start))
+        if args.task == 'lookup':
+            bench_lookup(dataset, args.workers, args.lookups, args.batch_size, args.order)
+        else:
+            bench_loader(dataset, args.batch_size, args.workers, args.batches)
+    else:
+        raise ValueError('unknown task: ' + args.task)
@@ -4,11 +4,17 @@ import time
 import tqdm
 import numpy as np
 import sys
+import itertools
+import json
+import contextlib
 from sklearn.metrics import roc_auc_score, log_loss
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, IterableDataset, BatchSampler, RandomSampler, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
 import torch.nn.utils.rnn as rnn_utils
+import torch.distributed as dist
 
-from src.dataset.position import PositionDataset
+from src.dataset.position import PositionDataset, PositionStreamDataset, PositionMultiLabelDataset, PositionBatch
+from src.dataset.sampler import BlockShuffleSampler
 from src.dataset.a9a import A9ADataset
 from src.model.lr import LogisticRegression
 from src.model.bilr import BiLogisticRegression
@@ -24,6 +30,9 @@ from src.model.bixdfm import BiExtremeDeepFactorizationMachineModel
 from src.model.extxdfm import ExtExtremeDeepFactorizationMachineModel
 from src.model.dfm import DeepFactorizationMachineModel
 from src.model.dcn import DeepCrossNetworkModel
+from src.optim import LazyAdam, LazyAdagrad
+from src.timer import StageTimer
+from src.metric import StreamingMetrics
 #from utility import recommend
 
 
@@ -68,20 +77,49 @@ def hook(self, input, output):
 #    value = rnn_utils.pad_sequence(value, batch_first=True, padding_value=0)
 #    return context, item, torch.FloatTensor(label), torch.FloatTensor(pos).unsqueeze(-1), value
 
-def get_dataset(name, path, data_prefix, rebuild_cache, max_dim=-1, test_flag=False):
+def get_dataset(name, path, data_prefix, rebuild_cache, max_dim=-1, test_flag=False, cache_type='lmdb', dedup_ctx=False, item_ids=False, value_type='auto', readahead=False, in_memory=False, stream=False, seed=0, ragged_ctx=False, labels_only=False):
+    if name == 'pos' and ',' in data_prefix:  # label variants of the same samples, e.g. rnd_gt.pos,rnd_gt,rnd_gt.const
+        if stream:
+            raise ValueError('multi-label datasets need a cache, not --stream 1')
+        # only the first variant's contexts are read, the others load their labels only
+        return PositionMultiLabelDataset([get_dataset(name, path, prefix, rebuild_cache, max_dim, test_flag, cache_type, dedup_ctx, item_ids, value_type, readahead, in_memory, seed=seed, ragged_ctx=ragged_ctx, labels_only=i > 0) for i, prefix in enumerate(data_prefix.split(','))])
+    if name == 'pos' and stream:
+        return PositionStreamDataset(path, data_prefix, tr_max_dim=max_dim, read_flag=test_flag, seed=seed, dedup_ctx=dedup_ctx, ragged_ctx=ragged_ctx, item_ids=item_ids)
     if name == 'pos':
         #return PositionDataset(path, data_prefix, True, max_dim, test_flag)
-        return PositionDataset(path, data_prefix, rebuild_cache, max_dim, test_flag)
+        return PositionDataset(path, data_prefix, rebuild_cache, max_dim, test_flag, cache_type, dedup_ctx=dedup_ctx, ragged_ctx=ragged_ctx, item_ids=item_ids, value_type=value_type, readahead=readahead, in_memory=in_memory, labels_only=labels_only)
     if name == 'a9a':
         return A9ADataset(path, training)
     else:
         raise ValueError('unknown dataset name: ' + name)
 
-def get_model(name, dataset, embed_dim):
+def get_data_loader(dataset, batch_size, shuffle=False, num_workers=10, batch_read=True, block_size=0, seed=0, rank=0, world_size=1):
+    if isinstance(dataset, IterableDataset):  # batches, shuffling and sharding come from the dataset itself
+        dataset.batch_size, dataset.shuffle, dataset.rank, dataset.world_size = batch_size, shuffle, rank, world_size
+        return DataLoader(dataset, batch_size=None, num_workers=num_workers, pin_memory=True)
+    if world_size > 1 and shuffle:  # every rank reads its own 1/world_size of the data, (seed, epoch) order, call set_epoch every epoch
+        if block_size > 0:
+            print('--block_size is ignored with --distributed 1, DistributedSampler shuffles samples')
+        sampler = DistributedSampler(dataset, world_size, rank, shuffle=True, seed=seed)
+    elif world_size > 1:
+        sampler = range(rank, len(dataset), world_size)  # no padding samples, so gathered metrics are exact
+    elif not shuffle:
+        sampler = SequentialSampler(dataset)
+    elif block_size > 0:  # locality-friendly shuffle for caches larger than RAM
+        sampler = BlockShuffleSampler(dataset, block_size, seed=seed)
+    else:
+        sampler = RandomSampler(dataset)
+    if batch_read and hasattr(dataset, 'get_batch'):
+        # one dataset call per batch of indices, no per-sample collate
+        return DataLoader(dataset, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last=False), num_workers=num_workers, pin_memory=True)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers, pin_memory=True)
+
+def get_model(name, dataset, embed_dim, item_ids=False, sparse=False, fused=False):
     """
     Hyperparameters are empirically determined, not opitmized.
     """
     input_dims = dataset.max_dim
+    items = dataset.items if item_ids else None  # item table kept on the model, batches then carry item ids only
     #if name == 'lr':
     #    return LogisticRegression(input_dims)
     #elif name == 'bilr':
@@ -95,11 +133,11 @@ def get_model(name, dataset, embed_dim):
     #elif name == 'extdssm':
     #    return ExtDSSM(input_dims, embed_dim, dataset.pos_num)
     if name == 'ffm':
-        return FFM(input_dims, embed_dim)
+        return FFM(input_dims, embed_dim, items, sparse, fused)
     elif name == 'biffm':
-        return BiFFM(input_dims, dataset.pos_num, embed_dim)
+        return BiFFM(input_dims, dataset.pos_num, embed_dim, items, sparse, fused)
     elif name == 'extffm':
-        return ExtFFM(input_dims, dataset.pos_num, embed_dim)
+        return ExtFFM(input_dims, dataset.pos_num, embed_dim, items, sparse, fused)
     #elif name == 'xdfm':
     #    return ExtremeDeepFactorizationMachineModel(input_dims, embed_dim=embed_dim*2, mlp_dims=(embed_dim, embed_dim), dropout=0.2, cross_layer_sizes=(embed_dim, embed_dim), split_half=True)
     #elif name == 'bixdfm':
@@ -114,6 +152,39 @@ def get_model(name, dataset, embed_dim):
         raise ValueError('unknown model name: ' + name)
 
 
+def grow_embedding(model, input_dims):
+    """
+    extend embed1 of a model trained on fewer features (tr) to input_dims rows (trva), new rows xavier-initialized
+    """
+    old = model.embed1
+    if old.num_embeddings >= input_dims:
+        return False
+    new = torch.nn.Embedding(input_dims, old.embedding_dim, padding_idx=0, sparse=old.sparse).to(old.weight.device)
+    torch.nn.init.xavier_uniform_(new.weight.data[1:, :])
+    new.weight.data[:old.num_embeddings] = old.weight.data
+    model.embed1 = new
+    return True
+
+def get_optimizer(name, model, model_name, learning_rate, weight_decay):
+    """
+    adam: torch.optim.Adam over dense gradients
+    lazy_adam, adagrad: LazyAdam, LazyAdagrad, the model has to be built with sparse embedding gradients
+    """
+    if name == 'adam':
+        optim_cls = torch.optim.Adam
+    elif name == 'lazy_adam':
+        optim_cls = LazyAdam
+    elif name == 'adagrad':
+        optim_cls = LazyAdagrad
+    else:
+        raise ValueError('unknown optimizer: ' + name)
+    if 'bi' in model_name or 'ext' in model_name:
+        return optim_cls(params=[
+            {'params': model.embed1.parameters()},
+            {'params': model.embed2.parameters(), 'weight_decay': 0.0}
+            ], lr=learning_rate, weight_decay=weight_decay)
+    return optim_cls(params=model.parameters(), lr=learning_rate, weight_decay=weight_decay)
+
 def model_helper(data_pack, model, model_name, device, mode='wps'):
     #if model_name in ['bilr', 'extlr']:
     #    data, target, pos = data_pack
@@ -127,17 +198,24 @@ def model_helper(data_pack, model, model_name, device, mode='wps'):
     #    else:
     #        y = model(context, item)
     if model_name in ['ffm', 'biffm', 'extffm',]: # 'bidssm', 'extdssm', 'bixdfm', 'extxdfm']:
-        context, item, target, pos, _, value = data_pack
-        #context, item, target, pos, value = context.to(device, torch.long), item.to(device, torch.long), target.to(device, torch.float), pos.to(device, torch.long), value.to(device, torch.float)
-        context, item, target, pos, value = merge_dims(context.to(device, non_blocking=True)), merge_dims(item.to(device, non_blocking=True)), merge_dims(target.to(device, non_blocking=True)), merge_dims(pos.to(device, non_blocking=True)), merge_dims(value.to(device, non_blocking=True))
+        if isinstance(data_pack, PositionBatch):  # already flattened by PositionDataset.get_batch
+            context, item, target, pos, value, ctx_rows, ctx_offsets = [t if t is None else t.to(device, non_blocking=True) for t in data_pack]
+        else:
+            ctx_rows, ctx_offsets = None, None
+            context, item, target, pos, _, value = data_pack
+            #context, item, target, pos, value = context.to(device, torch.long), item.to(device, torch.long), target.to(device, torch.float), pos.to(device, torch.long), value.to(device, torch.float)
+            context, item, target, pos, value = merge_dims(context.to(device, non_blocking=True)), merge_dims(item.to(device, non_blocking=True)), merge_dims(target.to(device, non_blocking=True)), merge_dims(pos.to(device, non_blocking=True)), merge_dims(value.to(device, non_blocking=True))
         if mode == 'wops':
             pos = torch.zeros_like(pos)
-        elif mode == 'wps':
+        elif mode in ('wps', 'both'):
             pass
         else:
             raise(ValueError, "model_helper's mode %s is wrong!"%mode)
-        if 'ffm' in model_name: #or 'dssm' in model_name:
-            y = model(context, item, pos, value)
+        if 'ffm' in model_name and mode == 'both':  # one forward, y = (wps, wops) predictions
+            x12, x3 = model.logits(context, item, pos, value, ctx_rows, ctx_offsets)
+            y = (model.combine(x12, x3), model.combine(x12, model.position_logit(torch.zeros_like(pos))))
+        elif 'ffm' in model_name: #or 'dssm' in model_name:
+            y = model(context, item, pos, value, ctx_rows, ctx_offsets)
         else:
             #y = model(context, item, pos)
             raise
@@ -148,19 +226,87 @@ def model_helper(data_pack, model, model_name, device, mode='wps'):
         raise
     return y, target
 
-def train(model, optimizer, data_loader, criterion, device, model_name, log_interval=1000):
+def average_gradients(model, world_size):
+    """
+    all-reduce the gradients of every rank and divide by world_size, sparse embedding gradients are
+    reduced as sparse tensors so only the rows in the batches travel. gloo reduces cpu tensors only,
+    gradients on cuda go through a cpu copy
+    """
+    for p in model.parameters():
+        if p.grad is None:
+            continue
+        if p.grad.is_sparse:
+            grad = p.grad.coalesce().cpu()
+            dist.all_reduce(grad)
+            p.grad = (grad/world_size).to(p.device)
+        else:
+            grad = p.grad.cpu()  # p.grad itself on cpu
+            dist.all_reduce(grad)
+            p.grad.copy_(grad).div_(world_size)
+
+def gather_tensor(t, world_size):
+    """
+    concatenate the 1-d cpu tensors t of every rank, t may have a different length on each rank
+    """
+    size = torch.tensor([t.numel()], dtype=torch.long)
+    sizes = [torch.zeros_like(size) for _ in range(world_size)]
+    dist.all_gather(sizes, size)
+    max_size = max(s.item() for s in sizes)
+    buf = torch.cat([t, t.new_zeros(max_size - t.numel())])
+    bufs = [torch.zeros_like(buf) for _ in range(world_size)]
+    dist.all_gather(bufs, buf)
+    return torch.cat([b[:s.item()] for b, s in zip(bufs, sizes)])
+
+def to_device(data_pack, device):
+    """
+    move a batch to device once, so several models can consume it
+    """
+    moved = [t if t is None else t.to(device, non_blocking=True) for t in data_pack]
+    return PositionBatch(*moved) if isinstance(data_pack, PositionBatch) else moved
+
+def timed_batches(batches, timer):
+    """
+    iterate batches, charging the wait for every batch to the 'data' stage of timer
+    """
+    it = iter(batches)
+    for i in itertools.count():
+        timer.step(i)
+        with timer.stage('data'):
+            tmp = next(it, None)
+        if tmp is None:
+            timer.stop_profile()
+            return
+        yield tmp
+
+def train(model, optimizer, data_loader, criterion, device, model_name, log_interval=1000, world_size=1, timer=None):
+    """
+    model, optimizer: one model or lists of replicas, replicas all train on every batch read once
+    timer: StageTimer of the epoch
+    return the last batch loss, a list of them for replicas
+    """
+    timer = timer if timer is not None else StageTimer(device, False)
+    if isinstance(model, list):
+        return train_replicas(model, optimizer, data_loader, criterion, device, model_name, world_size, timer)
     model.train()
     #handle = model.fc2.register_forward_hook(hook)
     #model(torch.LongTensor([[1]]).to(device), torch.LongTensor([[0,1,2,3,4,5,6,7,8,9,10]]).to(device))
     #handle.remove()
     total_loss = 0
     pbar = tqdm.tqdm(data_loader, smoothing=0, mininterval=1.0, ncols=100)
-    for i, tmp in enumerate(pbar):
-        y, target = model_helper(tmp, model, model_name, device, 'wps')
-        loss = criterion(y, target.float())
-        model.zero_grad()
-        loss.backward()
-        optimizer.step()
+    for i, tmp in enumerate(timed_batches(pbar, timer)):
+        with timer.stage('h2d'):
+            tmp = to_device(tmp, device)
+        with timer.stage('forward'):
+            y, target = model_helper(tmp, model, model_name, device, 'wps')
+            loss = criterion(y, target.float())
+        with timer.stage('backward'):
+            model.zero_grad()
+            loss.backward()
+            if world_size > 1:
+                average_gradients(model, world_size)
+        with timer.stage('step'):
+            optimizer.step()
+        timer.add_samples(target.shape[0])
         total_loss += loss.item()
         if (i + 1) % log_interval == 0:
             #print('    - loss:', total_loss / log_interval)
@@ -169,24 +315,159 @@ def train(model, optimizer, data_loader, criterion, device, model_name, log_inte
             total_loss = 0
     return loss.item()
 
-def test(model, data_loader, device, model_name, mode='wps'):
-    model.eval()
+def train_replicas(models, optimizers, data_loader, criterion, device, model_name, world_size, timer):
+    for model in models:
+        model.train()
+    for tmp in timed_batches(tqdm.tqdm(data_loader, smoothing=0, mininterval=1.0, ncols=100), timer):
+        with timer.stage('h2d'):
+            tmp = to_device(tmp, device)
+        losses = list()
+        for model, optimizer in zip(models, optimizers):
+            with timer.stage('forward'):
+                y, target = model_helper(tmp, model, model_name, device, 'wps')
+                loss = criterion(y, target.float())
+            with timer.stage('backward'):
+                model.zero_grad()
+                loss.backward()
+                if world_size > 1:
+                    average_gradients(model, world_size)
+            with timer.stage('step'):
+                optimizer.step()
+            losses.append(loss.item())
+        timer.add_samples(target.shape[0])
+    return losses
+
+def hogwild_worker(rank, workers, model, optimizer, dataset, criterion, model_name, batch_size, seed, queue):
+    torch.set_num_threads(1)  # one core per worker, the parallelism comes from the workers
+    model.train()
+    indices = np.arange(rank, len(dataset), workers)  # disjoint shard of this worker
+    np.random.RandomState(seed).shuffle(indices)
+    start = time.time()
+    loss = torch.tensor(float('nan'))  # reported for an empty shard
+    for i in range(0, len(indices), batch_size):
+        y, target = model_helper(dataset.get_batch(indices[i:i+batch_size]), model, model_name, torch.device('cpu'), 'wps')
+        loss = criterion(y, target.float())
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()  # lock-free update of the shared model and optimizer state
+    queue.put((rank, loss.item(), len(indices), time.time() - start))
+
+def train_hogwild(model, optimizer, dataset, criterion, model_name, batch_size, workers, seed):
+    """
+    One epoch of hogwild training on cpu: model and optimizer state in shared memory, every worker process
+    trains on its own shard without locks. Reports contexts/sec per worker and in total.
+    """
+    workers = max(1, min(workers, -(-len(dataset)//batch_size)))  # no more workers than batches, no empty shards
+    ctx = torch.multiprocessing.get_context('fork')
+    queue = ctx.SimpleQueue()
+    processes = [ctx.Process(target=hogwild_worker, args=(rank, workers, model, optimizer, dataset, criterion, model_name, batch_size, [seed, rank], queue)) for rank in range(workers)]
+    start = time.time()
+    for p in processes:
+        p.start()
+    try:
+        for p in processes:
+            p.join()
+            if p.exitcode != 0:
+                break
+    finally:  # on a failed worker or an interrupt, stop the workers still training on the shared model
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+    failed = ['worker:%d exitcode:%d'%(rank, p.exitcode) for rank, p in enumerate(processes) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError('hogwild workers failed: ' + ', '.join(failed))
+    sec = time.time() - start
+    results = sorted(queue.get() for _ in processes)
+    for rank, _, contexts, worker_sec in results:
+        print('worker:%d\tcontexts/sec:%.1f'%(rank, contexts/worker_sec))
+    print('workers:%d\tcontexts/sec:%.1f'%(workers, len(dataset)/sec))
+    return np.nanmean([r[1] for r in results])
+
+def test(model, data_loader, device, model_name, mode='wps', world_size=1, timer=None, metric='exact'):
+    """
+    model: one model or a list of replicas scored in one pass, return (auc, logloss) or a list of them
+        with a PositionMultiLabelDataset, (auc, logloss) of every label variant takes the place of (auc, logloss)
+        with mode 'both', {'wps': ..., 'wops': ...} from one forward takes the place of (auc, logloss)
+    metric:
+        exact: keep every prediction, sklearn roc_auc_score and log_loss
+        stream: StreamingMetrics on device, constant memory, binned AUC
+        check: both, print the streaming error and return the exact values
+    """
+    timer = timer if timer is not None else StageTimer(device, False)
+    if metric not in ('exact', 'stream', 'check'):
+        raise ValueError('unknown metric: ' + metric)
+    models = model if isinstance(model, list) else [model]
+    for m in models:
+        m.eval()
     #handle = model.fc2.register_forward_hook(hook)
     #model(torch.LongTensor([[1]]).to(device), torch.LongTensor([[0,1,2,3,4,5,6,7,8,9,10]]).to(device))
     #handle.remove()
-    targets, predicts = list(), list()
+    exact, stream = metric != 'stream', metric != 'exact'
+    outputs = ['wps', 'wops'] if mode == 'both' else [mode]
+    scorers = len(models)*len(outputs)  # predictions of model j, output o are scorer j*len(outputs) + o
+    targets, predicts, accumulators = None, [list() for _ in range(scorers)], None
     with torch.no_grad():
-        for i, tmp in enumerate(tqdm.tqdm(data_loader, smoothing=0, mininterval=1.0, ncols=100)):
-            y, target = model_helper(tmp, model, model_name, device, mode)
+        for i, tmp in enumerate(timed_batches(tqdm.tqdm(data_loader, smoothing=0, mininterval=1.0, ncols=100), timer)):
+            with timer.stage('h2d'):
+                tmp = to_device(tmp, device)
+            for j, m in enumerate(models):
+                with timer.stage('forward'):
+                    y, target = model_helper(tmp, m, model_name, device, mode)
+                target = target.view(target.shape[0], -1)  # (rows, label_num), one column per label variant
+                if targets is None:
+                    targets = [list() for _ in range(target.shape[1])]
+                    accumulators = [[StreamingMetrics(device) for _ in targets] for _ in range(scorers)] if stream else None
+                with timer.stage('metrics'):
+                    for o, _y in enumerate(y if isinstance(y, tuple) else (y,)):
+                        if stream:
+                            for acc, t in zip(accumulators[j*len(outputs) + o], target.unbind(1)):
+                                acc.update(_y, t)
+                        if exact:
+                            predicts[j*len(outputs) + o].extend(torch.flatten(_y).tolist())
             #num_of_user = y.size()[0]//10
-            targets.extend(torch.flatten(target.to(torch.int)).tolist())
-            predicts.extend(torch.flatten(y).tolist())
-    return roc_auc_score(targets, predicts), log_loss(targets, predicts)
+            with timer.stage('metrics'):
+                if exact:
+                    for labels, t in zip(targets, target.unbind(1)):
+                        labels.extend(t.to(torch.int).tolist())
+            timer.add_samples(target.shape[0])
+    with timer.stage('metrics'):
+        if world_size > 1:  # every rank scored its own shard
+            for acc in sum(accumulators or [], []):
+                acc.all_reduce()
+            if exact:
+                targets = [gather_tensor(torch.tensor(t, dtype=torch.int), world_size).tolist() for t in targets]
+                predicts = [gather_tensor(torch.tensor(p, dtype=torch.float64), world_size).tolist() for p in predicts]
+        if exact:
+            results = [[(roc_auc_score(t, p), log_loss(t, p)) for t in targets] for p in predicts]
+        else:
+            results = [[acc.compute() for acc in accs] for accs in accumulators]
+        if metric == 'check':
+            for model_results, accs in zip(results, accumulators):
+                for (auc, logloss), acc in zip(model_results, accs):
+                    stream_auc, stream_logloss = acc.compute()
+                    print('streaming metric error: auc %.3e logloss %.3e'%(abs(stream_auc - auc), abs(stream_logloss - logloss)))
+    results = [r[0] if len(r) == 1 else r for r in results]  # a list per model for multi-label datasets
+    if mode == 'both':
+        results = [dict(zip(outputs, results[j:j+len(outputs)])) for j in range(0, scorers, len(outputs))]
+    return results if isinstance(model, list) else results[0]
 
 
-def pred(model, data_loader, device, model_name, item_num):
+def score_catalog(model, data_pack, item_vectors, device, item_chunk=1<<16):
+    """
+    wops scores of every (context, item) pair of a batch of contexts: the context matrix C times the precomputed
+    item matrix I per chunk of items, then the no-position term, (context_num, item_num)
+    """
+    context, _, _, _, value, _, ctx_offsets = to_device(data_pack, device)
+    c = model.embed_context(context, value, ctx_offsets)
+    no_pos = torch.zeros(1, dtype=torch.long, device=device)
+    return torch.cat([model.output(c @ i.t(), no_pos) for i in item_vectors.split(item_chunk)], dim=1)
+
+def pred(model, data_loader, device, model_name, item_num, items):
+    """
+    data_loader: batches of contexts read once (PositionDataset with dedup_ctx), items: item feature rows
+    """
     num_of_pos = 10
-    res = np.empty(data_loader.batch_size//item_num*num_of_pos, dtype=np.int32)
     rngs = [np.random.RandomState(seed) for seed in [0,3,4,5,6]]
     bids = np.empty((len(rngs), item_num)) 
     for i, rng in enumerate(rngs):
@@ -196,12 +477,14 @@ def pred(model, data_loader, device, model_name, item_num):
     model.eval()
     targets, predicts = list(), list()
     with torch.no_grad():
+        item_vectors = model.embed_item(torch.as_tensor(items, dtype=torch.long, device=device))  # I, once
         fs = list()
         for j in range(len(rngs)):
             fs.append(open(os.path.join('tmp.pred.%d'%j), 'w'))
         for i, tmp in enumerate(tqdm.tqdm(data_loader, smoothing=0, mininterval=1.0, ncols=100)):
-            y, target = model_helper(tmp, model, model_name, device, mode='wops')
+            y = score_catalog(model, tmp, item_vectors, device).flatten()
             num_of_user = y.size()[0]//item_num
+            res = np.empty(num_of_user*num_of_pos, dtype=np.int32)
             #with open('dssm-unif.prob', 'a') as f:
             #    y = y.tolist()
             #    for j in range(num_of_user):
@@ -209,8 +492,8 @@ def pred(model, data_loader, device, model_name, item_num):
             for j in range(len(rngs)):
                 fp = fs[j]
                 out = y*(bids[j, :].repeat(num_of_user))
-                recommend.get_top_k_by_greedy(out.cpu().numpy(), num_of_user, item_num, num_of_pos, res[:num_of_user*num_of_pos])
-                _res = res[:num_of_user*num_of_pos].reshape(num_of_user, num_of_pos)
+                recommend.get_top_k_by_greedy(out.cpu().numpy(), num_of_user, item_num, num_of_pos, res)
+                _res = res.reshape(num_of_user, num_of_pos)
                 for r in range(num_of_user):
                     tmp = ['%d:%.4f:%0.4f'%(ad, y[r*item_num+ad], bids[j, ad]) for ad in _res[r, :]]
                     #tmp = ['%d:%.4f'%(ad, bids[j, ad]) for ad in _res[r, :]]
@@ -231,55 +514,170 @@ def main(dataset_name,
          weight_decay,
          device,
          save_dir,
-         ps):
+         ps,
+         cache_type,
+         batch_read,
+         dedup_ctx,
+         item_ids,
+         value_type,
+         readahead,
+         block_size,
+         seed,
+         in_memory,
+         stream,
+         ragged_ctx,
+         optim,
+         workers,
+         distributed,
+         local_rank,
+         timing,
+         profile_steps,
+         metric,
+         patience,
+         stop_metric,
+         fused):
     mkdir_if_not_exist(save_dir)
     device = torch.device(device)
     #if model_name in ['dssm', 'bidssm', 'extdssm', 'ffm', 'biffm', 'extffm', 'xdfm', 'dfm', 'dcn', 'bixdfm', 'extxdfm']:
     #    collate_fn = collate_fn_for_dssm  # output data: [context, item, pos]
     #else:
     #    collate_fn = collate_fn_for_lr  # output data: [item+context, pos] 
+    num_workers = 0 if in_memory else 10  # in-memory batches are cheap index ops, workers only add IPC
+    rank, world_size = 0, 1
+    if distributed:  # one process per rank, started by torch.distributed.launch (env:// rendezvous)
+        dist.init_process_group('gloo')
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        if device.type == 'cuda':  # one gpu per rank of the host, torchrun passes it as LOCAL_RANK
+            device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', local_rank)))
+            torch.cuda.set_device(device)
     if flag == 'train':
-        train_dataset = get_dataset(dataset_name, dataset_path, train_part, False)
-        valid_dataset = get_dataset(dataset_name, dataset_path, valid_part, False, train_dataset.get_max_dim() - 1)
-        train_data_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=10, pin_memory=True, shuffle=True)
-        valid_data_loader = DataLoader(valid_dataset, batch_size=batch_size, num_workers=10, pin_memory=True)
-        model = get_model(model_name, train_dataset, embed_dim).to(device)
-        criterion = torch.nn.BCELoss()
-        if 'bi' in model_name or 'ext' in model_name:
-            optimizer = torch.optim.Adam(params=[
-                {'params': model.embed1.parameters()},
-                {'params': model.embed2.parameters(), 'weight_decay': 0.0}
-                ], lr=learning_rate, weight_decay=weight_decay)
+        if stream and world_size > 1:  # shards give ranks unequal batch counts, the per-step all_reduce would hang
+            raise ValueError('--stream 1 can not train with --distributed 1, build a cache instead')
+        train_dataset = get_dataset(dataset_name, dataset_path, train_part, False, cache_type=cache_type, dedup_ctx=dedup_ctx, ragged_ctx=ragged_ctx, item_ids=item_ids, value_type=value_type, readahead=readahead, in_memory=in_memory, stream=stream, seed=seed)
+        valid_dataset = get_dataset(dataset_name, dataset_path, valid_part, False, train_dataset.get_max_dim() - 1, cache_type=cache_type, dedup_ctx=dedup_ctx, ragged_ctx=ragged_ctx, item_ids=item_ids, value_type=value_type, readahead=readahead, in_memory=in_memory, stream=stream, seed=seed)
+        train_data_loader = get_data_loader(train_dataset, batch_size, True, num_workers, batch_read, block_size, seed, rank, world_size)
+        valid_data_loader = get_data_loader(valid_dataset, batch_size, False, num_workers, batch_read, rank=rank, world_size=world_size)
+        if stop_metric not in ('logloss', 'auc'):
+            raise ValueError('unknown stop metric: ' + stop_metric)
+        # one replica per (learning_rate, weight_decay, embed_dim), all trained on the same batches
+        configs = list(itertools.product(learning_rate, weight_decay, embed_dim))
+        if model_path:  # continue from a checkpoint, e.g. the best tr epoch, instead of training from scratch
+            if len(configs) > 1:
+                raise ValueError('--model_path continues one model, give one hyperparameter setting')
+            models = [torch.load(model_path, map_location=device)]
+            if models[0].embed1.sparse != (optim != 'adam'):  # adam needs dense gradients, lazy_adam/adagrad sparse ones
+                raise ValueError('%s has %s embedding gradients, continue it with --optim %s'%(model_path, 'sparse' if models[0].embed1.sparse else 'dense', 'lazy_adam or adagrad' if models[0].embed1.sparse else 'adam'))
+            grown = grow_embedding(models[0], train_dataset.max_dim)
+            models[0].fused = fused
+            if item_ids and 'items' not in dict(models[0].named_buffers()):
+                models[0].register_buffer('items', torch.as_tensor(train_dataset.items, dtype=torch.long, device=device))
         else:
-            optimizer = torch.optim.Adam(params=model.parameters(), lr=learning_rate, weight_decay=weight_decay)
-        model_file_name = '_'.join([model_name, 'lr-'+str(learning_rate), 'l2-'+str(weight_decay), 'bs-'+str(batch_size), 'k-'+str(embed_dim), train_part])
-        with open(os.path.join(save_dir, model_file_name+'.log'), 'w') as log:
+            models = [get_model(model_name, train_dataset, k, item_ids, optim != 'adam', fused).to(device) for _, _, k in configs]
+        if world_size > 1:
+            if workers > 1:
+                raise ValueError('--distributed 1 and --workers > 1 can not be combined')
+            for model in models:
+                for t in model.state_dict().values():  # every rank starts from the weights of rank 0, through cpu for gloo
+                    c = t.cpu()
+                    dist.broadcast(c, 0)
+                    t.copy_(c)
+        criterion = torch.nn.BCELoss()
+        optimizers = [get_optimizer(optim, model, model_name, lr, wd) for model, (lr, wd, _) in zip(models, configs)]
+        if model_path and os.path.exists(model_path[:-len('.pt')] + '.optim.pt'):
+            if grown:  # moments of the old embedding shape do not fit
+                print('embed1 grew to %d rows, optimizer state of %s not loaded'%(train_dataset.max_dim, model_path))
+            else:
+                optimizers[0].load_state_dict(torch.load(model_path[:-len('.pt')] + '.optim.pt', map_location=device))
+        if workers > 1:
+            if device.type != 'cpu' or optim != 'adagrad' or not hasattr(train_dataset, 'get_batch') or len(models) > 1:
+                raise ValueError('--workers > 1 needs --device cpu, --optim adagrad, a cached dataset and one hyperparameter setting')
+            models[0].share_memory()
+            optimizers[0].share_memory()
+        model_file_names = ['_'.join([model_name, 'lr-'+str(lr), 'l2-'+str(wd), 'bs-'+str(batch_size), 'k-'+str(k), train_part]) for lr, wd, k in configs]
+        # per-stage timing of every epoch, one json line per epoch next to each .log
+        train_timer = StageTimer(device, timing, profile_steps if rank == 0 else None, os.path.join(save_dir, model_file_names[0]+'.trace.json'))
+        valid_timer = StageTimer(device, timing)
+        with contextlib.ExitStack() as stack:
+            logs = [stack.enter_context(open(os.path.join(save_dir, name+'.log') if rank == 0 else os.devnull, 'w')) for name in model_file_names]
+            timing_logs = [stack.enter_context(open(os.path.join(save_dir, name+'.timing.json') if rank == 0 and timing else os.devnull, 'w')) for name in model_file_names]
+            best, stale = [None]*len(models), [0]*len(models)  # early stopping on the first valid part
             for epoch_i in range(epoch):
                 #print(model.embed2.weight.data.t())
-                tr_logloss = train(model, optimizer, train_data_loader, criterion, device, model_name)
-                va_auc, va_logloss = test(model, valid_data_loader, device, model_name, 'wps')
-                print('epoch:%d\ttr_logloss:%.6f\tva_auc:%.6f\tva_logloss:%.6f'%(epoch_i, tr_logloss, va_auc, va_logloss))
-                log.write('epoch:%d\ttr_logloss:%.6f\tva_auc:%.6f\tva_logloss:%.6f\n'%(epoch_i, tr_logloss, va_auc, va_logloss))
+                if hasattr(train_dataset, 'set_epoch'):  # workers hold copies, so the epoch is set from here
+                    train_dataset.set_epoch(epoch_i)
+                sampler = getattr(train_data_loader.sampler, 'sampler', train_data_loader.sampler)  # unwrap BatchSampler, e.g. to the DistributedSampler
+                if hasattr(sampler, 'set_epoch'):
+                    sampler.set_epoch(epoch_i)
+                train_timer.reset()
+                if workers > 1:
+                    tr_loglosses = [train_hogwild(models[0], optimizers[0], train_dataset, criterion, model_name, batch_size, workers, seed + epoch_i)]
+                elif len(models) == 1:
+                    tr_loglosses = [train(models[0], optimizers[0], train_data_loader, criterion, device, model_name, world_size=world_size, timer=train_timer)]
+                else:
+                    tr_loglosses = train(models, optimizers, train_data_loader, criterion, device, model_name, world_size=world_size, timer=train_timer)
+                train_summary = train_timer.summary()
+                valid_timer.reset()
+                results = test(models, valid_data_loader, device, model_name, 'wps', world_size, valid_timer, metric)
+                timing_line = json.dumps({'epoch': epoch_i, 'train': train_summary, 'valid': valid_timer.summary()})
+                for timing_log in timing_logs:
+                    timing_log.write(timing_line + '\n')
+                    timing_log.flush()
+                for name, log, tr_logloss, result in zip(model_file_names, logs, tr_loglosses, results):
+                    variants = result if isinstance(result, list) else [result]
+                    va_auc, va_logloss = variants[0]  # the first of several valid parts goes to the .log
+                    if rank == 0:
+                        print('%sepoch:%d\ttr_logloss:%.6f\tva_auc:%.6f\tva_logloss:%.6f'%('' if len(models) == 1 else name + '\t', epoch_i, tr_logloss, va_auc, va_logloss))
+                        for part, (auc, logloss) in list(zip(valid_part.split(','), variants))[1:]:
+                            print('%s\tva_auc:%.6f\tva_logloss:%.6f'%(part, auc, logloss))
+                    log.write('epoch:%d\ttr_logloss:%.6f\tva_auc:%.6f\tva_logloss:%.6f\n'%(epoch_i, tr_logloss, va_auc, va_logloss))
+                    log.flush()
+                for j, result in enumerate(results):
+                    va_auc, va_logloss = result[0] if isinstance(result, list) else result
+                    score = va_auc if stop_metric == 'auc' else -va_logloss
+                    if best[j] is not None and score <= best[j]:
+                        stale[j] += 1
+                        continue
+                    best[j], stale[j] = score, 0
+                    if patience > 0 and rank == 0:  # best checkpoint, continue from it with --model_path
+                        torch.save(models[j], f'{save_dir}/{model_file_names[j]}.best.pt')
+                        torch.save(optimizers[j].state_dict(), f'{save_dir}/{model_file_names[j]}.best.optim.pt')
+                if patience > 0 and min(stale) >= patience:
+                    if rank == 0:
+                        print('early stop at epoch %d, no %s improvement for %d epochs'%(epoch_i, stop_metric, patience))
+                    break
                 #print('epoch:%d\ttr_logloss:%.6f\n'%(epoch_i, tr_logloss))
                 #log.write('epoch:%d\ttr_logloss:%.6f\n'%(epoch_i, tr_logloss))
-        torch.save(model, f'{save_dir}/{model_file_name}.pt')
+        if rank == 0:
+            for model, name in zip(models, model_file_names):
+                torch.save(model, f'{save_dir}/{name}.pt')
     elif flag == 'pred':
-        train_dataset = get_dataset(dataset_name, dataset_path, train_part, False)
-        valid_dataset = get_dataset(dataset_name, dataset_path, valid_part, False, train_dataset.get_max_dim() - 1, True)
+        train_dataset = get_dataset(dataset_name, dataset_path, train_part, False, cache_type=cache_type, dedup_ctx=dedup_ctx, item_ids=item_ids, value_type=value_type, readahead=readahead)
+        # contexts are read once and scored against the whole catalog, see score_catalog
+        valid_dataset = get_dataset(dataset_name, dataset_path, valid_part, False, train_dataset.get_max_dim() - 1, 0, cache_type, True, False, value_type, readahead, ragged_ctx=ragged_ctx)
         item_num = valid_dataset.get_item_num()
-        refine_batch_size = int(batch_size//item_num*item_num)  # batch_size should be a multiple of item_num 
-        valid_data_loader = DataLoader(valid_dataset, batch_size=refine_batch_size, num_workers=8, pin_memory=True)
-        model = torch.load(model_path).to(device)
-        pred(model, valid_data_loader, device, model_name, item_num)
+        valid_data_loader = get_data_loader(valid_dataset, max(1, batch_size//item_num), False, 8)  # batch_size rows, as before
+        model = torch.load(model_path, map_location=device)
+        pred(model, valid_data_loader, device, model_name, item_num, valid_dataset.items)
     elif flag == 'test_auc':
-        train_dataset = get_dataset(dataset_name, dataset_path, train_part, False)
-        valid_dataset = get_dataset(dataset_name, dataset_path, valid_part, False, train_dataset.get_max_dim() - 1)
-        valid_data_loader = DataLoader(valid_dataset, batch_size=batch_size, num_workers=8, pin_memory=True)
+        train_dataset = get_dataset(dataset_name, dataset_path, train_part, False, cache_type=cache_type, dedup_ctx=dedup_ctx, ragged_ctx=ragged_ctx, item_ids=item_ids, value_type=value_type, readahead=readahead, stream=stream)
+        valid_dataset = get_dataset(dataset_name, dataset_path, valid_part, False, train_dataset.get_max_dim() - 1, cache_type=cache_type, dedup_ctx=dedup_ctx, ragged_ctx=ragged_ctx, item_ids=item_ids, value_type=value_type, readahead=readahead, in_memory=in_memory, stream=stream)
+        valid_data_loader = get_data_loader(valid_dataset, batch_size, False, 0 if in_memory else 8, batch_read)
         #print(device)
         model = torch.load(model_path, map_location=device)
-        va_auc, va_logloss = test(model, valid_data_loader, device, model_name, ps)
+        model.fused = fused
+        if item_ids and 'items' not in dict(model.named_buffers()):  # model saved without its item table
+            model.register_buffer('items', torch.as_tensor(valid_dataset.items, dtype=torch.long, device=device))
+        result = test(model, valid_data_loader, device, model_name, ps, metric=metric)
         print("model logloss auc")
-        print("%s %.6f %.6f"%(model_name, va_logloss, va_auc))
+        # --ps both scores wps and wops from one forward, one line per mode tagged with it
+        for mode, r in (sorted(result.items()) if isinstance(result, dict) else [(None, result)]):
+            name = model_name if mode is None else '%s:%s'%(model_name, mode)
+            if isinstance(r, list):  # one line per valid part
+                for part, (va_auc, va_logloss) in zip(valid_part.split(','), r):
+                    print("%s:%s %.6f %.6f"%(name, part, va_logloss, va_auc))
+            else:
+                va_auc, va_logloss = r
+                print("%s %.6f %.6f"%(name, va_logloss, va_auc))
         #pred(model, valid_data_loader, device, model_name, item_num)
     else:
         raise ValueError('Flag should be "train"/"pred"/"test_auc"!')
@@ -289,6 +687,9 @@ def main(dataset_name,
 if __name__ == '__main__':
     import argparse
 
+    def floats(s):
+        return [float(i) for i in s.split(',')]
+
     parser = argparse.ArgumentParser()
     parser.add_argument('--dataset_name', default='pos')
     parser.add_argument('--train_part', default='tr')
@@ -296,15 +697,36 @@ if __name__ == '__main__':
     parser.add_argument('--dataset_path', help='the path that contains item.svm, va.svm, tr.svm trva.svm')
     parser.add_argument('--flag', default='train')
     parser.add_argument('--model_name', default='dssm')
-    parser.add_argument('--model_path', default='', help='the path of model file')
+    parser.add_argument('--model_path', default='', help='the path of model file, for the train flag the checkpoint to continue from')
     parser.add_argument('--epoch', type=float, default=30.)
-    parser.add_argument('--learning_rate', type=float, default=0.001)
+    parser.add_argument('--learning_rate', type=floats, default=[0.001], help='comma-separated values train one replica per (learning_rate, weight_decay, embed_dim) in one pass')
     parser.add_argument('--batch_size', type=float, default=8192.)
-    parser.add_argument('--embed_dim', type=float, default=16.)
-    parser.add_argument('--weight_decay', type=float, default=1e-6)
+    parser.add_argument('--embed_dim', type=floats, default=[16.])
+    parser.add_argument('--weight_decay', type=floats, default=[1e-6])
     parser.add_argument('--device', default='cuda:0', help='format like "cuda:0" or "cpu"')
     parser.add_argument('--save_dir', default='logs')
-    parser.add_argument('--ps', default='wps')
+    parser.add_argument('--ps', default='wps', help='"wps", "wops", or "both" to score both from one forward (ffm models)')
+    parser.add_argument('--cache_type', default='lmdb', help='"lmdb" or "mmap"')
+    parser.add_argument('--block_size', type=int, default=0, help='>0: shuffle training data by blocks of this many contexts, see BlockShuffleSampler, not with --distributed 1')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--in_memory', type=int, default=0, help='1: load the cache into shared-memory tensors and read batches without DataLoader workers')
+    parser.add_argument('--readahead', type=int, default=0, help='1: lmdb readahead, only helps sequential reads')
+    parser.add_argument('--value_type', default='auto', help='context value storage of a new cache: "auto", "none", "float16" or "float32"')
+    parser.add_argument('--batch_read', type=int, default=1, help='1: read a whole batch per dataset call, 0: per-sample read and collate')
+    parser.add_argument('--dedup_ctx', type=int, default=0, help='1: ship every context once per batch and broadcast it in the model, needs --batch_read 1')
+    parser.add_argument('--item_ids', type=int, default=0, help='1: ship item ids and gather item features from the model item table, needs --batch_read 1')
+    parser.add_argument('--ragged_ctx', type=int, default=0, help='1: ship contexts without padding as flat idx + offsets, the model sums them with embedding_bag, needs --batch_read 1')
+    parser.add_argument('--optim', default='adam', help='"adam", or "lazy_adam" / "adagrad": sparse embedding gradients, only the rows in a batch are updated')
+    parser.add_argument('--workers', type=int, default=1, help='>1: hogwild training with this many cpu processes, needs --device cpu --optim adagrad')
+    parser.add_argument('--distributed', type=int, default=0, help='1: gloo data-parallel training, launch one process per rank with torch.distributed.launch')
+    parser.add_argument('--local_rank', type=int, default=0, help='set by torch.distributed.launch, the cuda device of this rank with --distributed 1 and a cuda --device')
+    parser.add_argument('--timing', type=int, default=0, help='1: time every training stage, one json line per epoch in <log name>.timing.json')
+    parser.add_argument('--profile_steps', default='', help='"start:end": profiler trace of these training steps of the first epoch in <log name>.trace.json')
+    parser.add_argument('--metric', default='exact', help='"exact": sklearn over every prediction, "stream": constant-memory on-device auc/logloss, "check": both and print the difference')
+    parser.add_argument('--patience', type=int, default=0, help='>0: stop after this many epochs without va improvement, and save <log name>.best.pt at every improvement')
+    parser.add_argument('--stop_metric', default='logloss', help='"logloss" or "auc", the va metric of --patience')
+    parser.add_argument('--fused', type=int, default=0, help='1: ffm models compute the context-item interaction with layer.bag_dot')
+    parser.add_argument('--stream', type=int, default=0, help='1: read batches straight from the svm files without a cache, see PositionStreamDataset, not with --distributed 1 training')
     args = parser.parse_args()
     main(args.dataset_name,
          args.train_part,
@@ -316,9 +738,30 @@ if __name__ == '__main__':
          int(args.epoch),
          args.learning_rate,
          int(args.batch_size),
-         int(args.embed_dim),
+         [int(k) for k in args.embed_dim],
          args.weight_decay,
          args.device,
          args.save_dir,
-         args.ps)
+         args.ps,
+         args.cache_type,
+         bool(args.batch_read),
+         bool(args.dedup_ctx),
+         bool(args.item_ids),
+         args.value_type,
+         bool(args.readahead),
+         args.block_size,
+         args.seed,
+         bool(args.in_memory),
+         bool(args.stream),
+         bool(args.ragged_ctx),
+         args.optim,
+         args.workers,
+         bool(args.distributed),
+         args.local_rank,
+         bool(args.timing),
+         tuple(int(i) for i in args.profile_steps.split(':')) if args.profile_steps else None,
+         args.metric,
+         args.patience,
+         args.stop_metric,
+         bool(args.fused))
 
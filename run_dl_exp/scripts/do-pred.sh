@@ -5,6 +5,11 @@
 gpu=$1
 mode=$2
 ps=$3
+if [ "${ps}" != "wps" ] && [ "${ps}" != "wops" ]; then
+    # --ps both prints model:wps:part lines, the per-variant logs below hold one ps each
+    echo "ps should be wps or wops, got: ${ps}" >&2
+    exit 1
+fi
 va_prefix="rnd_gt"
 root="test-score.${mode}"
 model_path=`find ${root} -name "*.pt"`
@@ -13,25 +18,27 @@ model_name=`echo $(basename ${model_path}) | cut -d'_' -f1`
 echo "model_name: ${model_name}, model_path: ${model_path}"
 
 task() {
-for i in '.' 
+# rnd_gt, rnd_gt.const and rnd_gt.pos share contexts and items, score them in one pass
+va="${va_prefix}.const,${va_prefix},${va_prefix}.pos"
+cmd="python ../../main.py"
+cmd="${cmd} --dataset_name pos"
+cmd="${cmd} --train_part trva"
+cmd="${cmd} --valid_part ${va}" 
+cmd="${cmd} --dataset_path ./"
+cmd="${cmd} --flag test_auc"
+cmd="${cmd} --model_name ${model_name}"
+cmd="${cmd} --model_path ${model_path}"
+cmd="${cmd} --device cuda:${gpu}"
+cmd="${cmd} --batch_size 1024"
+cmd="${cmd} --ps ${ps}"
+echo "${cmd} > ${root}/${va_prefix}.out"
+}
+
+# Split the "model:part logloss auc" lines into one log per variant, exp_*.sh read test-score.${mode}/rnd*log
+split_logs() {
+for va in ${va_prefix}.const ${va_prefix} ${va_prefix}.pos
 do
-	for j in '' 'const.' 'pos.'
-	do
-		va="${va_prefix}${i}${j}"
-		va=`echo ${va} | rev | cut -c 2- | rev`
-		cmd="python ../../main.py"
-		cmd="${cmd} --dataset_name pos"
-		cmd="${cmd} --train_part trva"
-		cmd="${cmd} --valid_part ${va}" 
-		cmd="${cmd} --dataset_path ./"
-		cmd="${cmd} --flag test_auc"
-		cmd="${cmd} --model_name ${model_name}"
-		cmd="${cmd} --model_path ${model_path}"
-		cmd="${cmd} --device cuda:${gpu}"
-		cmd="${cmd} --batch_size 1024"
-		cmd="${cmd} --ps ${ps}"
-		echo "${cmd} > ${root}/${va_prefix}${i}${j}log"
-	done
+	(echo "model logloss auc"; grep "^${model_name}:${va} " ${root}/${va_prefix}.out | sed "s/^${model_name}:${va} /${model_name} /") > ${root}/${va}.log
 done
 }
 
@@ -43,4 +50,4 @@ wait
 # Run
 echo "Run"
 task | xargs -0 -d '\n' -P 1 -I {} sh -c {} 
-
+split_logs
@@ -6,6 +6,7 @@ gpu=$1
 mode=$2
 model_name=$3
 ps=$4
+cont=$5  # 1: continue from the best tr checkpoint (grid.sh with --patience) for one trva epoch
 
 # Data set
 ds='pos'
@@ -21,6 +22,10 @@ bs=`python select_params.py logs ${mode} | cut -d' ' -f3`
 k=`python select_params.py logs ${mode} | cut -d' ' -f4`
 epoch=`python select_params.py logs ${mode} | cut -d' ' -f5`
 epoch=$((${epoch}+1))
+init_model="logs/${model_name}_lr-${lr}_l2-${wd}_bs-${bs%.*}_k-${k%.*}_tr.best.pt"
+if [ "${cont}" == "1" ]; then
+    epoch=1
+fi
 
 # others 
 log_path="test-score.${mode}"
@@ -43,6 +48,9 @@ cmd="${cmd} --ps ${ps}"
 cmd="${cmd} --learning_rate ${lr}"
 cmd="${cmd} --weight_decay ${wd}"
 cmd="${cmd} --embed_dim ${k}"
+if [ "${cont}" == "1" ]; then
+    cmd="${cmd} --model_path ${init_model}"
+fi
 echo "${cmd}"
 }
 
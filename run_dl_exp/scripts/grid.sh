@@ -6,6 +6,12 @@ gpu=$1
 mode=$2
 model_name=$3
 ps=$4
+one_pass=$5  # 1: train the whole grid as replicas in one main.py run
+patience=${6:-0}  # >0: early stopping, keeps logs/*.best.pt for do-test.sh
+stop_metric='logloss'
+if [ "${mode}" == "auc" ]; then
+    stop_metric='auc'
+fi
 
 # Data set
 ds='pos'
@@ -18,6 +24,11 @@ flag='train'
 epoch=20
 bs=512
 
+# Grid, shared by the per-pair loops and the one-pass command
+lrs='0.001' #0.001 0.0001
+wds='1e-5 1e-6 1e-7'
+ks='32'
+
 # others
 log_path="logs"
 device="cuda:${gpu}"
@@ -36,13 +47,21 @@ train_cmd="${train_cmd} --device ${device}"
 train_cmd="${train_cmd} --save_dir ${log_path}"
 train_cmd="${train_cmd} --batch_size ${bs}"
 train_cmd="${train_cmd} --ps ${ps}"
+train_cmd="${train_cmd} --patience ${patience}"
+train_cmd="${train_cmd} --stop_metric ${stop_metric}"
+
+# One command, one replica per parameter pair
+if [ "${one_pass}" == "1" ]; then
+    echo "${train_cmd} --learning_rate `echo ${lrs} | tr ' ' ','` --weight_decay `echo ${wds} | tr ' ' ','` --embed_dim `echo ${ks} | tr ' ' ','`"
+    return
+fi
 
 # Print out all parameter pair
-for lr in 0.001 #0.001 0.0001
+for lr in ${lrs}
 do
-    for wd in 1e-5 1e-6 1e-7
+    for wd in ${wds}
     do
-        for k in 32 
+        for k in ${ks}
         do
             cmd="${train_cmd} --learning_rate ${lr}"
             cmd="${cmd} --weight_decay ${wd}"
@@ -53,7 +72,6 @@ do
 done
 }
 
-
 # Check command
 echo "Check command list (the command may not be runned!!)"
 task
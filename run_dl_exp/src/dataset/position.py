@@ -6,15 +6,472 @@ import numpy as np
 import lmdb
 import shutil
 import struct
-import subprocess
 import random
+import multiprocessing
 from tqdm import tqdm
 from pathlib import Path
-from torch.utils.data import Dataset, DataLoader
+from collections import namedtuple
+from torch.utils.data import Dataset, IterableDataset, DataLoader
 import torch.nn.utils.rnn as rnn_utils
 
-class PositionDataset(Dataset):
-    def __init__(self, dataset_path=None, data_prefix='tr', rebuild_cache=False, tr_max_dim=-1, read_flag=0):
+def _iter_lines(data_path, start, end):
+    '''
+    yield the non-empty lines starting in bytes [start, end) of data_path
+    '''
+    with open(data_path, 'rb') as fd:
+        if start > 0:
+            fd.seek(start - 1)
+            fd.readline()  # the line crossing start belongs to the previous range
+        while fd.tell() < end:
+            line = fd.readline()
+            if not line:
+                break
+            line = line.decode().strip()
+            if line:
+                yield line
+
+
+def _parse_line(line):
+    '''
+    "item:label,item:label,... idx:value idx:value ..." -> (item_idx, label, ctx_idx, ctx_value) tuples
+    '''
+    labels, context = line.split(' ', 1)
+    labels = labels.strip().split(',')
+    item_idx, label = zip(*[[int(j) for j in i.split(':')[:2]] for i in labels])
+    ctx_idx, ctx_value = zip(*[[float(j) for j in i.split(':')] for i in context.split(' ')])
+    return item_idx, label, ctx_idx, ctx_value
+
+
+def _byte_ranges(data_path, shard_num):
+    bounds = np.linspace(0, os.path.getsize(data_path), shard_num + 1).astype(np.int64)
+    return [(int(bounds[i]), int(bounds[i+1])) for i in range(shard_num)]
+
+
+def _read_items(item_path):
+    '''
+    item.svm -> int32 (item_num, max_item_num) item feature idx, padded with 0
+    '''
+    with open(item_path, 'r') as fi:
+        items = [[int(j.split(':')[0]) for j in line.strip().split(' ')] for line in fi if line.strip()]
+    item_array = np.zeros((len(items), max(len(i) for i in items)), dtype=np.int32)
+    for i, item in enumerate(items):
+        item_array[i, :len(item)] = item
+    return item_array
+
+
+def _parse_shard(args):
+    '''
+    parse the lines starting in bytes [start, end) of data_path and save them to shard_path,
+    contexts are saved flat with their lengths since max_ctx_num is unknown until every shard is done
+    return (sample_num, max_ctx_num, max_dim, all context values are 1) of the shard
+    '''
+    data_path, start, end, shard_path = args
+    item_idx, label, ctx_len, ctx_idx, ctx_value = list(), list(), list(), list(), list()
+    for line in _iter_lines(data_path, start, end):
+        _item_idx, _label, _ctx_idx, _ctx_value = _parse_line(line)
+        item_idx.append(_item_idx)
+        label.append(_label)
+        ctx_len.append(len(_ctx_idx))
+        ctx_idx.extend(_ctx_idx)
+        ctx_value.extend(_ctx_value)
+    ctx_value = np.array(ctx_value, dtype=np.float32)
+    np.savez(shard_path,
+             item_idx=np.array(item_idx, dtype=np.int32),
+             label=np.array(label, dtype=np.float32),
+             ctx_len=np.array(ctx_len, dtype=np.int32),
+             ctx_idx=np.array(ctx_idx, dtype=np.int64),
+             ctx_value=ctx_value)
+    return len(ctx_len), max(ctx_len, default=0), int(max(ctx_idx, default=0)), bool((ctx_value == 1).all())
+
+
+def _scan_shard(args):
+    '''
+    header of the lines starting in bytes [start, end) of data_path: (sample_num, pos_num, max_dim)
+    '''
+    data_path, start, end = args
+    sample_num, pos_num, max_dim = 0, 0, 0
+    for line in _iter_lines(data_path, start, end):
+        labels, context = line.split(' ', 1)
+        pos_num = labels.count(',') + 1
+        max_dim = max(max_dim, max(int(float(i.split(':', 1)[0])) for i in context.split(' ')))
+        sample_num += 1
+    return sample_num, pos_num, max_dim
+
+
+def _records_to_block(records):
+    '''
+    list of _parse_line outputs -> (item_idx, label, ctx_idx, ctx_value) arrays, ctx_* padded to the longest context
+    '''
+    ctx_len = max(len(r[2]) for r in records)
+    ctx_idx = np.zeros((len(records), ctx_len), dtype=np.int64)
+    ctx_value = np.zeros((len(records), ctx_len), dtype=np.float32)
+    for i, (_, _, idx, value) in enumerate(records):
+        ctx_idx[i, :len(idx)] = idx
+        ctx_value[i, :len(value)] = value
+    return np.array([r[0] for r in records], dtype=np.int32), np.array([r[1] for r in records], dtype=np.float32), ctx_idx, ctx_value
+
+
+def _merge_shards(shard_paths, max_ctx_num):
+    '''
+    yield blocks of (item_idx, label, ctx_idx, ctx_value, ctx_len) in file order, ctx_* are padded to max_ctx_num
+    '''
+    for shard_path in shard_paths:
+        with np.load(shard_path) as shard:
+            ctx_len = shard['ctx_len']
+            if ctx_len.shape[0] == 0:
+                continue
+            mask = np.arange(max_ctx_num) < ctx_len[:, None]
+            ctx_idx = np.zeros(mask.shape, dtype=np.int64)
+            ctx_value = np.zeros(mask.shape, dtype=np.float32)
+            ctx_idx[mask] = shard['ctx_idx']
+            ctx_value[mask] = shard['ctx_value']
+            yield shard['item_idx'], shard['label'], ctx_idx, ctx_value, ctx_len
+
+
+# on-disk record schema
+#   version 0: every column is float32
+#   version 1: int32 indices, uint8 labels, context values as value_type
+CACHE_VERSION = 1
+VALUE_TYPES = ['none', 'float16', 'float32']  # none: every context value is 1 and is not stored
+VALUE_DTYPES = {'none': None, 'float16': np.float16, 'float32': np.float32}
+
+
+def _check_block(item_idx, label, ctx_idx):
+    if ctx_idx.max() > np.iinfo(np.int32).max or item_idx.max() > np.iinfo(np.int32).max:
+        raise ValueError('feature index out of int32 range')
+    if label.min() < 0 or label.max() > np.iinfo(np.uint8).max or (label != np.round(label)).any():
+        raise ValueError('labels should be integers in [0, 255]')
+
+
+class LmdbCache(object):
+    '''
+    Every sample is stored as two keys:
+        citem_%d: int32 (pos_num,) item idx, uint8 (pos_num,) label
+        ctx_%d: int32 (ctx_num,) context idx, (ctx_num,) context value as value_type, not padded
+    Caches without a version key are version 0 and hold float32 (2, pos_num) and (2, max_ctx_num) records,
+    read() decodes both to the same arrays.
+    Every process (e.g. a forked DataLoader worker) lazily opens its own environment and keeps one read
+    transaction for all its lookups. readahead is off by default as lookups are random, max_readers only
+    matters for environments opened with locking.
+    '''
+    def __init__(self, cache_path, readahead=False, max_readers=126):
+        self.cache_path = cache_path
+        self.readahead = readahead
+        self.max_readers = max_readers
+        self.txn, self.pid = None, None
+        self.env = self.__open_env()
+        with self.env.begin(write=False) as txn:
+            self.max_dim = np.frombuffer(txn.get(b'max_dim'), dtype=np.int32)[0]
+            self.item_num = np.frombuffer(txn.get(b'item_num'), dtype=np.int32)[0]
+            self.items = np.frombuffer(txn.get(b'items'), dtype=np.int32).reshape((self.item_num, -1))
+            self.pos_num = np.frombuffer(txn.get(b'pos_num'), dtype=np.int32)[0]
+            self.max_ctx_num = np.frombuffer(txn.get(b'max_ctx_num'), dtype=np.int32)[0]
+            self.max_item_num = np.frombuffer(txn.get(b'max_item_num'), dtype=np.int32)[0]
+            version = txn.get(b'version')
+            if version is None:
+                print('%s is a version 0 cache, records are converted while reading, rebuild it for the compact layout.'%cache_path)
+                self.version, self.value_type = 0, 'float32'
+                self.length = (txn.stat()['entries'] - 6)//2
+            else:
+                self.version = np.frombuffer(version, dtype=np.int32)[0]
+                self.value_type = txn.get(b'value_type').decode()
+                self.length = (txn.stat()['entries'] - 8)//2
+        self.value_dtype = VALUE_DTYPES[self.value_type]
+        self.ctx_bytes = 4 + (0 if self.value_dtype is None else np.dtype(self.value_dtype).itemsize)
+
+    def __open_env(self):
+        self.pid = os.getpid()
+        return lmdb.open(self.cache_path, create=False, lock=False, readonly=True, readahead=self.readahead, max_readers=self.max_readers)
+
+    def __get_txn(self):
+        if self.pid != os.getpid():  # inherited from the parent process, never share an environment across fork
+            self.env, self.txn = self.__open_env(), None
+        if self.txn is None:
+            self.txn = self.env.begin(write=False, buffers=True)
+        return self.txn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['env'], state['txn'], state['pid'] = None, None, None
+        return state
+
+    def read(self, indices):
+        if isinstance(indices, slice):
+            indices = range(*indices.indices(self.length))
+        item_idx = np.empty((len(indices), self.pos_num), dtype=np.int32)
+        label = np.empty((len(indices), self.pos_num), dtype=np.float32)
+        ctx_idx = np.zeros((len(indices), self.max_ctx_num), dtype=np.int64)
+        ctx_value = np.zeros((len(indices), self.max_ctx_num), dtype=np.float32)
+        txn = self.__get_txn()
+        for i, idx in enumerate(indices):
+            citem = txn.get(b'citem_%d'%int(idx))
+            ctx = txn.get(b'ctx_%d'%int(idx))
+            if self.version == 0:
+                item_idx[i], label[i] = np.frombuffer(citem, dtype=np.float32).reshape((2, -1))
+                ctx_idx[i], ctx_value[i] = np.frombuffer(ctx, dtype=np.float32).reshape((2, -1))
+                continue
+            item_idx[i] = np.frombuffer(citem, dtype=np.int32, count=self.pos_num)
+            label[i] = np.frombuffer(citem, dtype=np.uint8, offset=4*self.pos_num)
+            ctx_num = len(ctx)//self.ctx_bytes
+            ctx_idx[i, :ctx_num] = np.frombuffer(ctx, dtype=np.int32, count=ctx_num)
+            if self.value_dtype is None:
+                ctx_value[i, :ctx_num] = 1
+            else:
+                ctx_value[i, :ctx_num] = np.frombuffer(ctx, dtype=self.value_dtype, offset=4*ctx_num)
+        return item_idx, label, ctx_idx, ctx_value
+
+    def read_labels(self, indices):
+        '''
+        (item_idx, label) of read(), the ctx keys are not touched
+        '''
+        if isinstance(indices, slice):
+            indices = range(*indices.indices(self.length))
+        item_idx = np.empty((len(indices), self.pos_num), dtype=np.int32)
+        label = np.empty((len(indices), self.pos_num), dtype=np.float32)
+        txn = self.__get_txn()
+        for i, idx in enumerate(indices):
+            citem = txn.get(b'citem_%d'%int(idx))
+            if self.version == 0:
+                item_idx[i], label[i] = np.frombuffer(citem, dtype=np.float32).reshape((2, -1))
+                continue
+            item_idx[i] = np.frombuffer(citem, dtype=np.int32, count=self.pos_num)
+            label[i] = np.frombuffer(citem, dtype=np.uint8, offset=4*self.pos_num)
+        return item_idx, label
+
+    @staticmethod
+    def build(cache_path, items, max_ctx_num, max_item_num, blocks, value_type='float32'):
+        value_dtype = VALUE_DTYPES[value_type]
+        max_dim = np.zeros(1, dtype=np.int32)
+        item_num = np.array([items.shape[0]], dtype=np.int32)
+        pos_num = np.zeros(1, dtype=np.int32)
+        sample_idx = 0
+        with lmdb.open(cache_path, map_size=int(1e11)) as env:
+            for item_idx, label, ctx_idx, ctx_value, ctx_len in blocks:
+                _check_block(item_idx, label, ctx_idx)
+                citem_array = np.hstack((item_idx.astype(np.int32).view(np.uint8), label.astype(np.uint8)))
+                ctx_idx32 = ctx_idx.astype(np.int32)
+                if value_dtype is not None:
+                    ctx_value = ctx_value.astype(value_dtype)
+                with env.begin(write=True) as txn:
+                    for i in range(citem_array.shape[0]):
+                        ctx = ctx_idx32[i, :ctx_len[i]].tobytes()
+                        if value_dtype is not None:
+                            ctx += ctx_value[i, :ctx_len[i]].tobytes()
+                        txn.put(b'citem_%d'%sample_idx, citem_array[i].tobytes())
+                        txn.put(b'ctx_%d'%sample_idx, ctx)
+                        sample_idx += 1
+                max_dim[0] = max(max_dim[0], ctx_idx.max())
+                pos_num[0] = item_idx.shape[1]
+
+            with env.begin(write=True) as txn:
+                txn.put(b'items', items.tobytes())
+                txn.put(b'max_dim', max_dim.tobytes())
+                txn.put(b'item_num', item_num.tobytes())
+                txn.put(b'pos_num', pos_num.tobytes())
+                txn.put(b'max_ctx_num', np.array([max_ctx_num], dtype=np.int32).tobytes())
+                txn.put(b'max_item_num', np.array([max_item_num], dtype=np.int32).tobytes())
+                txn.put(b'version', np.array([CACHE_VERSION], dtype=np.int32).tobytes())
+                txn.put(b'value_type', value_type.encode())
+
+
+class MmapCache(object):
+    '''
+    Columnar cache, a directory of contiguous arrays which are memory-mapped on open:
+        meta.npy: int32 [max_dim, item_num, pos_num, max_ctx_num, max_item_num, length, version, value_type]
+        items.npy: int32 (item_num, max_item_num)
+        item_idx.bin: int32 (length, pos_num)
+        label.bin: uint8 (length, pos_num)
+        ctx_idx.bin: int32 (length, max_ctx_num)
+        ctx_value.bin: value_type (length, max_ctx_num), absent if value_type is none
+    A sample, or a range of samples, is a slice of these arrays.
+    Version 0 caches have no version/value_type in meta.npy and a float32 label.bin and ctx_value.bin.
+    '''
+    @staticmethod
+    def columns(version, value_type):
+        columns = [('item_idx', np.int32, 'pos_num'), ('label', np.uint8 if version > 0 else np.float32, 'pos_num'), ('ctx_idx', np.int32, 'max_ctx_num')]
+        if VALUE_DTYPES[value_type] is not None:
+            columns.append(('ctx_value', VALUE_DTYPES[value_type], 'max_ctx_num'))
+        return columns
+
+    def __init__(self, cache_path):
+        meta = np.load(os.path.join(cache_path, 'meta.npy'))
+        self.max_dim, self.item_num, self.pos_num, self.max_ctx_num, self.max_item_num, self.length = meta[:6]
+        if len(meta) == 6:
+            self.version, self.value_type = 0, 'float32'
+        else:
+            self.version, self.value_type = meta[6], VALUE_TYPES[meta[7]]
+        self.items = np.load(os.path.join(cache_path, 'items.npy'))
+        self.ctx_value = None
+        for name, dtype, width in self.columns(self.version, self.value_type):
+            setattr(self, name, np.memmap(os.path.join(cache_path, name + '.bin'), dtype=dtype, mode='r', shape=(self.length, getattr(self, width))))
+
+    def read(self, indices):
+        if not isinstance(indices, slice):
+            indices = np.asarray(indices)
+        ctx_idx = self.ctx_idx[indices].astype(np.int64)
+        if self.ctx_value is None:
+            ctx_value = (ctx_idx != 0).astype(np.float32)
+        else:
+            ctx_value = self.ctx_value[indices].astype(np.float32)
+        return np.asarray(self.item_idx[indices]), self.label[indices].astype(np.float32), ctx_idx, ctx_value
+
+    def read_labels(self, indices):
+        '''
+        (item_idx, label) of read(), the ctx columns are not touched
+        '''
+        if not isinstance(indices, slice):
+            indices = np.asarray(indices)
+        return np.asarray(self.item_idx[indices]), self.label[indices].astype(np.float32)
+
+    @staticmethod
+    def build(cache_path, items, max_ctx_num, max_item_num, blocks, value_type='float32'):
+        columns = MmapCache.columns(CACHE_VERSION, value_type)
+        max_dim, pos_num, length = 0, 0, 0
+        os.makedirs(cache_path)
+        fds = [open(os.path.join(cache_path, name + '.bin'), 'wb') for name, _, _ in columns]
+        try:
+            for block in blocks:
+                item_idx, label, ctx_idx, _, _ = block
+                _check_block(item_idx, label, ctx_idx)
+                for fd, (_, dtype, _), array in zip(fds, columns, block):
+                    array.astype(dtype).tofile(fd)
+                max_dim = max(max_dim, ctx_idx.max())
+                pos_num = item_idx.shape[1]
+                length += item_idx.shape[0]
+        finally:
+            for fd in fds:
+                fd.close()
+        np.save(os.path.join(cache_path, 'items.npy'), items)
+        np.save(os.path.join(cache_path, 'meta.npy'), np.array([max_dim, items.shape[0], pos_num, max_ctx_num, max_item_num, length, CACHE_VERSION, VALUE_TYPES.index(value_type)], dtype=np.int32))
+
+
+class MemoryCache(object):
+    '''
+    The whole of another cache copied once into shared-memory tensors, read() is plain indexing in the calling
+    process, so no DataLoader workers are needed. Only for datasets which fit in RAM.
+    labels_only: copy item_idx and label only, read() is then unavailable and read_labels() is the read path
+    '''
+    def __init__(self, cache, chunk_size=int(1e6), labels_only=False):
+        for name in ('max_dim', 'item_num', 'items', 'pos_num', 'max_ctx_num', 'max_item_num', 'length'):
+            setattr(self, name, getattr(cache, name))
+        self.labels_only = labels_only
+        self.item_idx = torch.empty((self.length, self.pos_num), dtype=torch.int32).share_memory_()
+        self.label = torch.empty((self.length, self.pos_num), dtype=torch.float32).share_memory_()
+        tensors = [self.item_idx, self.label]
+        self.ctx_idx, self.ctx_value = None, None
+        if not labels_only:
+            self.ctx_idx = torch.empty((self.length, self.max_ctx_num), dtype=torch.int32).share_memory_()
+            self.ctx_value = torch.empty((self.length, self.max_ctx_num), dtype=torch.float32).share_memory_()
+            tensors += [self.ctx_idx, self.ctx_value]
+        pbar = tqdm(range(0, self.length, chunk_size), mininterval=1, smoothing=0.1)
+        pbar.set_description('Load position dataset cache into memory')
+        for start in pbar:
+            end = min(start + chunk_size, self.length)
+            arrays = cache.read_labels(slice(start, end)) if labels_only else cache.read(slice(start, end))
+            for tensor, array in zip(tensors, arrays):
+                tensor.numpy()[start:end] = array
+
+    def read(self, indices):
+        if self.labels_only:
+            raise ValueError('a labels_only MemoryCache holds no contexts, use read_labels()')
+        if not isinstance(indices, slice):
+            indices = torch.as_tensor(np.asarray(indices), dtype=torch.long)
+        return self.item_idx[indices].numpy(), self.label[indices].numpy(), self.ctx_idx[indices].numpy().astype(np.int64), self.ctx_value[indices].numpy()
+
+    def read_labels(self, indices):
+        if not isinstance(indices, slice):
+            indices = torch.as_tensor(np.asarray(indices), dtype=torch.long)
+        return self.item_idx[indices].numpy(), self.label[indices].numpy()
+
+
+CACHE_TYPES = {'lmdb': LmdbCache, 'mmap': MmapCache}
+
+# a whole batch of (context, item) rows, already flattened to (batch_size*rows_per_context, ...)
+# if ctx_rows is not None, context and value hold each context once and ctx_rows maps every row to its context
+PositionBatch = namedtuple('PositionBatch', ['context', 'item', 'target', 'pos', 'value', 'ctx_rows', 'ctx_offsets'], defaults=(None, None))
+
+
+class PositionBatchBuilder(object):
+    '''
+    Turns (item_idx, label, ctx_idx, ctx_value) arrays of a batch of contexts into a PositionBatch.
+    Subclasses set read_flag, tr_max_dim, dedup_ctx, ragged_ctx, item_ids, items, item_num, item_set, pos_num, seed, rng and rng_pid.
+    '''
+    def _make_batch(self, item_idxes, flags, ctx_idx, ctx_value):
+        batch_size = item_idxes.shape[0]
+        if self.read_flag in (1, 2, 3, 4):
+            item_idxes = self._sample_items(item_idxes)
+        elif self.read_flag != 0:
+            raise ValueError('Wrong flag %d for reading data'%self.read_flag)
+        rows = item_idxes.shape[1]
+        if self.read_flag == 0:
+            pos = np.tile(np.arange(1, self.pos_num+1, dtype=np.int64), batch_size)
+        else:
+            flags = np.full(item_idxes.shape, -1, dtype=np.float32)
+            pos = np.zeros(batch_size*rows, dtype=np.int64)
+        if self.tr_max_dim > 0:
+            mask = ctx_idx > self.tr_max_dim
+            ctx_idx = np.where(mask, 0, ctx_idx)
+            ctx_value = np.where(mask, 0, ctx_value)
+        if self.dedup_ctx:
+            ctx_rows = torch.from_numpy(np.repeat(np.arange(batch_size, dtype=np.int64), rows))
+        else:
+            ctx_idx, ctx_value = np.repeat(ctx_idx, rows, axis=0), np.repeat(ctx_value, rows, axis=0)
+            ctx_rows = None
+        ctx_offsets = None
+        if self.ragged_ctx:  # drop the padding, every context is a bag of ctx_idx[ctx_offsets[i]:ctx_offsets[i+1]]
+            mask = ctx_idx != 0
+            ctx_offsets = torch.from_numpy(np.concatenate(([0], np.cumsum(mask.sum(axis=1))[:-1])).astype(np.int64))
+            ctx_idx, ctx_value = ctx_idx[mask], ctx_value[mask]
+        if self.item_ids:
+            items = item_idxes.reshape(-1).astype(np.int64)
+        else:
+            items = self.items[item_idxes.reshape(-1), :]
+        return PositionBatch(torch.from_numpy(ctx_idx),
+                             torch.from_numpy(items),
+                             torch.from_numpy(np.ascontiguousarray(flags, dtype=np.float32).reshape((-1,) + flags.shape[2:])),
+                             torch.from_numpy(pos),
+                             torch.from_numpy(np.ascontiguousarray(ctx_value, dtype=np.float32)),
+                             ctx_rows,
+                             ctx_offsets)
+
+    def _get_rng(self):
+        '''
+        generator of the current process, seeded by (seed, DataLoader worker id) so candidates are reproducible
+        '''
+        if self.rng is None or self.rng_pid != os.getpid():
+            worker_info = torch.utils.data.get_worker_info()
+            self.rng = np.random.default_rng([self.seed, 0 if worker_info is None else worker_info.id])
+            self.rng_pid = os.getpid()
+        return self.rng
+
+    def _sample_items(self, item_idxes):
+        '''
+        candidate items of read_flag 1-4 for a (batch_size, pos_num) array of shown items, one draw for the whole batch
+        '''
+        batch_size = item_idxes.shape[0]
+        if self.read_flag == 1:
+            return np.tile(self.item_set, (batch_size, 1))
+        elif self.read_flag == 2:
+            keys = self._get_rng().random((batch_size, self.item_num))
+            return keys.argsort(axis=1)[:, :self.pos_num].astype(np.int32)
+        elif self.read_flag == 3:
+            return self._complement(item_idxes)
+        else:
+            keys = self._get_rng().random((batch_size, self.item_num))
+            keys[np.arange(batch_size)[:, None], item_idxes] = 2  # shown items sort after every candidate
+            return keys.argsort(axis=1)[:, :self.pos_num].astype(np.int32)
+
+    def _complement(self, item_idxes):
+        '''
+        per row, sorted items not in item_idxes, same as np.setxor1d(row, self.item_set, True)
+        '''
+        mask = np.ones((item_idxes.shape[0], self.item_num), dtype=np.bool_)
+        mask[np.arange(item_idxes.shape[0])[:, None], item_idxes] = False
+        return np.nonzero(mask)[1].reshape((item_idxes.shape[0], -1))
+
+
+class PositionDataset(PositionBatchBuilder, Dataset):
+    def __init__(self, dataset_path=None, data_prefix='tr', rebuild_cache=False, tr_max_dim=-1, read_flag=0, cache_type='lmdb', build_workers=-1, dedup_ctx=False, ragged_ctx=False, item_ids=False, value_type='auto', seed=0, readahead=False, max_readers=126, in_memory=False, labels_only=False):
         '''
         test_flag: 
             0: cntx_num*position_num
@@ -22,176 +479,127 @@ class PositionDataset(Dataset):
             2: cntx_num*item_num, then randomly choose position_num items
             3: cntx_num*(item_num-position_num)
             4: cntx_num*(item_num-position_num), then randomly choose position_num items
+        cache_type: 
+            lmdb: two lmdb keys per sample
+            mmap: memory-mapped column arrays, see MmapCache
+        build_workers: processes parsing the svm file when building the cache, -1 for all cpus
+        value_type: how a new cache stores context values, one of VALUE_TYPES,
+            auto: none if every value is 1, else float32
+        dedup_ctx: get_batch emits every context once with a context->rows index instead of tiling it
+        ragged_ctx: get_batch emits the non-padding context idx and values flat with per-context offsets
+        item_ids: get_batch emits item ids instead of item feature rows, the model gathers them from its own item table
+        seed: seed of the candidate sampling of read_flag 2 and 4, every DataLoader worker draws from (seed, worker id)
+        readahead, max_readers: lmdb environment options, see LmdbCache
+        in_memory: copy the whole cache into shared-memory tensors, see MemoryCache
+        labels_only: with in_memory, copy item idx and labels only, for the extra label variants of a PositionMultiLabelDataset
         '''
+        if cache_type not in CACHE_TYPES:
+            raise ValueError('unknown cache type: ' + cache_type)
+        if value_type != 'auto' and value_type not in VALUE_TYPES:
+            raise ValueError('unknown value type: ' + value_type)
         self.tr_max_dim = tr_max_dim
         self.read_flag = read_flag
+        self.dedup_ctx = dedup_ctx
+        self.ragged_ctx = ragged_ctx
+        self.item_ids = item_ids
+        self.seed = seed
+        self.rng, self.rng_pid = None, None
         data_path = os.path.join(dataset_path, data_prefix + '.svm')
         item_path = os.path.join(dataset_path, 'item.svm')
         assert Path(data_path).exists(), "%s does not exist!"%data_path
-        cache_path = os.path.join(dataset_path, data_prefix + '.lmdb')
+        cache_path = os.path.join(dataset_path, data_prefix + '.' + cache_type)
 
         # build cache
         if rebuild_cache or not Path(cache_path).exists():
             shutil.rmtree(cache_path, ignore_errors=True)
             if dataset_path is None:
                 raise ValueError('create cache: failed: dataset_path is None')
-            self.__build_cache(data_path, item_path, cache_path)
+            self.__build_cache(data_path, item_path, cache_path, CACHE_TYPES[cache_type], build_workers if build_workers > 0 else os.cpu_count(), value_type)
 
         # read data
         print('Reading data from %s.'%(cache_path))
-        self.env = lmdb.open(cache_path, create=False, lock=False, readonly=True)
-        with self.env.begin(write=False) as txn:
-            self.max_dim = np.frombuffer(txn.get(b'max_dim'), dtype=np.int32)[0] + 1  # idx from 0 to max_dim_in_svmfile, 0 for padding
-            self.item_num = np.frombuffer(txn.get(b'item_num'), dtype=np.int32)[0]
-            self.items=np.frombuffer(txn.get(b'items'), dtype=np.int32).reshape((self.item_num, -1)).astype(np.long)
-            self.pos_num = np.frombuffer(txn.get(b'pos_num'), dtype=np.int32)[0]
-            self.max_ctx_num = np.frombuffer(txn.get(b'max_ctx_num'), dtype=np.int32)[0]
-            self.max_item_num = np.frombuffer(txn.get(b'max_item_num'), dtype=np.int32)[0]
-            #self.length = self.pos_num*(txn.stat()['entries'] - 6)//2 if self.read_flag == 1 else self.item_num*(txn.stat()['entries'] - 6)//2
-            self.length = (txn.stat()['entries'] - 6)//2 
-            self.item_set = np.arange(self.item_num, dtype=np.int32)
-            print('Totally %d items, %d dims, %d positions, %d samples'%(self.item_num, self.max_dim, self.pos_num, self.length))
-    
-    def __build_cache(self, data_path, item_path, cache_path):
-        max_dim = np.zeros(1, dtype=np.int32)
-        item_num = np.zeros(1, dtype=np.int32)
-        pos_num = np.zeros(1, dtype=np.int32)
-        max_ctx_num = np.zeros(1, dtype=np.int32)
-        max_item_num = np.zeros(1, dtype=np.int32)
-
-        ctx_col = subprocess.run("awk 'BEGIN{max = 0}{if (NF+0 >= max+0) max=NF}END{print max}' %s"%data_path, shell=True,stdout=subprocess.PIPE,stderr=subprocess.PIPE,encoding="utf-8")
-        item_col = subprocess.run("awk 'BEGIN{max = 0}{if (NF+0 >= max+0) max=NF}END{print max}' %s"%item_path, shell=True,stdout=subprocess.PIPE,stderr=subprocess.PIPE,encoding="utf-8")
-        if ctx_col.returncode or item_col.returncode:
-            raise ValueError('Can get %s or %s max_col_num!'%(data_path, item_path))
+        if cache_type == 'lmdb':
+            self.cache = LmdbCache(cache_path, readahead, max_readers)
         else:
-            self.max_ctx_num = int(ctx_col.stdout.strip()) - 1
-            self.max_item_num = int(item_col.stdout.strip())
-            max_ctx_num[0] = self.max_ctx_num
-            max_item_num[0] = self.max_item_num
-            print('max_ctx_num:%d, max_item_num:%d'%(self.max_ctx_num, self.max_item_num))
-
-        with lmdb.open(cache_path, map_size=int(1e11)) as env:
-            i = 0
-            items = np.zeros((300, self.max_item_num), dtype=np.int32)
-            with open(item_path, 'r') as fi:
-                pbar = tqdm(fi, mininterval=1, smoothing=0.1)
-                pbar.set_description('Create position dataset cache: setup lmdb for item')
-                for line in pbar:
-                    line = line.strip()
-                    for _num, j in enumerate(line.split(' ')):
-                        items[i, _num] = int(j.split(':')[0])
-                    i += 1
-            items = items[:i, :]
-            #print(items.shape)
-            item_num[0] = i
-                
-            for buf in self.__yield_buffer(data_path):
-                with env.begin(write=True) as txn:
-                    for item_key, item_array, ctx_key, ctx_array, max_dim_buf, pos_num[0] in buf:
-                        txn.put(item_key, item_array)
-                        txn.put(ctx_key, ctx_array)
-                        if  max_dim_buf > max_dim[0]:
-                            max_dim[0] = max_dim_buf
-        
-            with env.begin(write=True) as txn:
-                txn.put(b'items', items.tobytes())
-                txn.put(b'max_dim', max_dim.tobytes())
-                txn.put(b'item_num', item_num.tobytes())
-                txn.put(b'pos_num', pos_num.tobytes())
-                txn.put(b'max_ctx_num', max_ctx_num.tobytes())
-                txn.put(b'max_item_num', max_item_num.tobytes())
+            self.cache = CACHE_TYPES[cache_type](cache_path)
+        if in_memory:
+            start = time.time()
+            self.cache = MemoryCache(self.cache, labels_only=labels_only)
+            print('Loaded %s into memory in %.1f sec.'%(cache_path, time.time() - start))
+        self.max_dim = self.cache.max_dim + 1  # idx from 0 to max_dim_in_svmfile, 0 for padding
+        self.item_num = self.cache.item_num
+        self.items = self.cache.items.astype(np.long)
+        self.pos_num = self.cache.pos_num
+        self.max_ctx_num = self.cache.max_ctx_num
+        self.max_item_num = self.cache.max_item_num
+        self.length = self.cache.length
+        self.item_set = np.arange(self.item_num, dtype=np.int32)
+        print('Totally %d items, %d dims, %d positions, %d samples'%(self.item_num, self.max_dim, self.pos_num, self.length))
+    
+    def __build_cache(self, data_path, item_path, cache_path, cache_cls, workers, value_type, shard_size=int(1.28e8)):
+        item_array = _read_items(item_path)
+        self.max_item_num = item_array.shape[1]
 
-    def __yield_buffer(self, data_path, buffer_size=int(1e6)):
-        sample_idx, max_dim, pos_num = 0, 0, 0
-        buf = list()
-        with open(data_path, 'r') as fd:
-            pbar = tqdm(fd, mininterval=1, smoothing=0.1)
-            pbar.set_description('Create position dataset cache: setup lmdb for context')
-            for line in pbar:
-                line = line.strip()
-                labels, context = line.split(' ', 1)
-                labels = labels.strip().split(',')
-                pos_num = len(labels)
-                item_idx, item_value = zip(*[[int(j) for j in i.split(':')[:2]] for i in labels])
-                ctx_idx, ctx_value = zip(*[[float(j) for j in i.split(':')] for i in context.split(' ')])
-                item_array = np.zeros((2, pos_num), dtype=np.float32)
-                item_array[0, :] = item_idx
-                item_array[1, :] = item_value
-                ctx_array = np.zeros((2, self.max_ctx_num), dtype=np.float32)
-                ctx_array[0, :len(ctx_idx)] = ctx_idx
-                ctx_array[1, :len(ctx_value)] = ctx_value
-                tmp_max_dim = max(ctx_idx)
-                if tmp_max_dim > max_dim:
-                    max_dim = tmp_max_dim
-                buf.append((b'citem_%d'%sample_idx, item_array.tobytes(), b'ctx_%d'%sample_idx ,ctx_array.tobytes(), max_dim, pos_num))
-                sample_idx += 1
-                if sample_idx % buffer_size == 0:
-                    yield buf
-                    buf.clear()
-            yield buf
+        # parse byte-range shards of data_path in parallel, then merge them into one cache in file order
+        shard_dir = cache_path + '.shards'
+        shutil.rmtree(shard_dir, ignore_errors=True)
+        os.makedirs(shard_dir)
+        try:
+            shard_num = max(workers, -(-os.path.getsize(data_path)//shard_size))
+            shards = [(data_path, start, end, os.path.join(shard_dir, '%d.npz'%i)) for i, (start, end) in enumerate(_byte_ranges(data_path, shard_num))]
+            with multiprocessing.Pool(workers) as pool:
+                pbar = tqdm(pool.imap(_parse_shard, shards), total=shard_num, mininterval=1, smoothing=0.1)
+                pbar.set_description('Create position dataset cache: parse %s with %d processes'%(data_path, workers))
+                sample_nums, max_ctx_nums, max_dims, all_ones = zip(*pbar)
+            self.max_ctx_num = max(max_ctx_nums)
+            if value_type == 'auto':
+                value_type = 'none' if all(all_ones) else 'float32'
+            print('max_ctx_num:%d, max_item_num:%d, max_dim:%d, %d samples, value_type:%s'%(self.max_ctx_num, self.max_item_num, max(max_dims), sum(sample_nums), value_type))
+            cache_cls.build(cache_path, item_array, self.max_ctx_num, self.max_item_num, _merge_shards([s[-1] for s in shards], self.max_ctx_num), value_type)
+        finally:
+            shutil.rmtree(shard_dir, ignore_errors=True)
 
     def __len__(self):
         return self.length
 
+    def get_batch(self, indices):
+        '''
+        vectorized read of a list of contexts, returns a PositionBatch of tensors with the same rows as
+        merge_dims over a default-collated batch of __getitem__
+        '''
+        return self._make_batch(*self.cache.read(indices))
+
     #@profile
     def __getitem__(self, idx):  # idx = 10*context_idx + pos
+        if isinstance(idx, (list, np.ndarray)):  # from a BatchSampler, see get_batch
+            return self.get_batch(idx)
+        item_idxes, flags, ctx_idx, ctx_value = [a[0] for a in self.cache.read([idx])]
+        ctx_idx = ctx_idx.astype(np.long)  # context
+        ctx_value = ctx_value.copy()  # context
         if self.read_flag == 0:
             #context_idx, pos = divmod(idx, self.pos_num)
-            with self.env.begin(write=False) as txn:
-                item_array = np.frombuffer(txn.get(b'citem_%d'%idx), dtype=np.float32)
-                ctx_array = np.frombuffer(txn.get(b'ctx_%d'%idx), dtype=np.float32)
-                item_idxes = item_array[:self.pos_num].astype(np.int32)
-                flags = item_array[self.pos_num:]
-
-                items = self.items[item_idxes, :].astype(np.long)
-                ctx_idx = ctx_array[:self.max_ctx_num].astype(np.long)  # context
-                ctx_value = ctx_array[self.max_ctx_num:].copy()  # context
+            items = self.items[item_idxes, :].astype(np.long)
             pos = np.arange(1, self.pos_num+1, dtype=np.long)
         elif self.read_flag == 1:
             #context_idx, item_idx = divmod(idx, self.item_num)
-            with self.env.begin(write=False) as txn:
-                item_array = np.frombuffer(txn.get(b'citem_%d'%idx), dtype=np.float32)
-                ctx_array = np.frombuffer(txn.get(b'ctx_%d'%idx), dtype=np.float32)
-
-                items = self.items[:self.item_num, :].astype(np.long)
-                ctx_idx = ctx_array[:self.max_ctx_num].astype(np.long)  # context
-                ctx_value = ctx_array[self.max_ctx_num:].copy()  # context
+            items = self.items[:self.item_num, :].astype(np.long)
             item_idxes = np.arange(self.item_num, dtype=np.int32)
             flags = np.ones(self.item_num)*-1
             pos = np.zeros(self.item_num)
         elif self.read_flag == 2:
             #context_idx, item_idx = divmod(idx, self.item_num)
-            with self.env.begin(write=False) as txn:
-                item_array = np.frombuffer(txn.get(b'citem_%d'%idx), dtype=np.float32)
-                ctx_array = np.frombuffer(txn.get(b'ctx_%d'%idx), dtype=np.float32)
-
-                item_idxes = np.random.choice(self.item_set, self.pos_num, replace=False)
-                items = self.items[item_idxes, :].astype(np.long)
-                ctx_idx = ctx_array[:self.max_ctx_num].astype(np.long)  # context
-                ctx_value = ctx_array[self.max_ctx_num:].copy()  # context
+            item_idxes = self._sample_items(item_idxes[None, :])[0]
+            items = self.items[item_idxes, :].astype(np.long)
             flags = np.ones(self.pos_num)*-1
             pos = np.zeros(self.pos_num)
         elif self.read_flag == 3:
-            with self.env.begin(write=False) as txn:
-                item_array = np.frombuffer(txn.get(b'citem_%d'%idx), dtype=np.float32)
-                ctx_array = np.frombuffer(txn.get(b'ctx_%d'%idx), dtype=np.float32)
-                item_idxes = np.setxor1d(item_array[:self.pos_num].astype(np.int32), self.item_set, True)
-
-                items = self.items[item_idxes, :].astype(np.long)
-                ctx_idx = ctx_array[:self.max_ctx_num].astype(np.long)  # context
-                ctx_value = ctx_array[self.max_ctx_num:].copy()  # context
+            item_idxes = np.setxor1d(item_idxes, self.item_set, True)
+            items = self.items[item_idxes, :].astype(np.long)
             flags = np.ones(self.item_num - self.pos_num)*-1
             pos = np.zeros(self.item_num - self.pos_num)
         elif self.read_flag == 4:
-            with self.env.begin(write=False) as txn:
-                item_array = np.frombuffer(txn.get(b'citem_%d'%idx), dtype=np.float32)
-                ctx_array = np.frombuffer(txn.get(b'ctx_%d'%idx), dtype=np.float32)
-                item_idxes = np.setxor1d(item_array[:self.pos_num].astype(np.int32), self.item_set, True)
-                item_idxes = np.random.choice(item_idxes, self.pos_num, replace=False)
-
-                items = self.items[item_idxes, :].astype(np.long)
-                ctx_idx = ctx_array[:self.max_ctx_num].astype(np.long)  # context
-                ctx_value = ctx_array[self.max_ctx_num:].copy()  # context
+            item_idxes = self._sample_items(item_idxes[None, :])[0]
+            items = self.items[item_idxes, :].astype(np.long)
             flags = np.ones(self.pos_num)*-1
             pos = np.zeros(self.pos_num)
         else:
@@ -219,6 +627,161 @@ class PositionDataset(Dataset):
     def get_item_num(self):
         return self.item_num
 
+
+class PositionMultiLabelDataset(Dataset):
+    '''
+    PositionDatasets of files with the same contexts and items line by line, only the labels differ
+    (rnd_gt, rnd_gt.const, rnd_gt.pos), read as one dataset: get_batch reads contexts and items from the first
+    and only items and labels (read_labels) from the others, so target is (rows, label_num). read_flag 0 only, batches only.
+    '''
+    def __init__(self, datasets):
+        self.datasets = datasets
+        base = datasets[0]
+        if base.read_flag != 0:
+            raise ValueError('multi-label datasets need read_flag 0')
+        if any(len(d) != len(base) or d.pos_num != base.pos_num for d in datasets[1:]):
+            raise ValueError('multi-label datasets need the same samples in every file')
+        self.max_dim = base.max_dim
+        self.item_num = base.item_num
+        self.items = base.items
+        self.pos_num = base.pos_num
+        self.length = base.length
+
+    def __len__(self):
+        return self.length
+
+    def get_batch(self, indices):
+        item_idxes, flags, ctx_idx, ctx_value = self.datasets[0].cache.read(indices)
+        labels = [flags]
+        for d in self.datasets[1:]:
+            _item_idxes, _flags = d.cache.read_labels(indices)
+            if not np.array_equal(_item_idxes, item_idxes):
+                raise ValueError('multi-label datasets need the same items in every file')
+            labels.append(_flags)
+        return self.datasets[0]._make_batch(item_idxes, np.stack(labels, axis=-1), ctx_idx, ctx_value)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, np.ndarray)):
+            return self.get_batch(idx)
+        raise ValueError('multi-label datasets are read by batches only')
+
+    def get_max_dim(self):
+        return self.max_dim
+
+    def get_item_num(self):
+        return self.item_num
+
+
+def _scan_svm(data_path, workers):
+    '''
+    (sample_num, pos_num, max_dim) of data_path, scanned by workers processes and kept in data_path + '.header.npy'
+    until the size or mtime of data_path changes
+    '''
+    header_path = data_path + '.header.npy'
+    stat = os.stat(data_path)
+    if Path(header_path).exists():
+        header = np.load(header_path)
+        if header[0] == stat.st_size and header[1] == stat.st_mtime_ns:
+            return tuple(int(i) for i in header[2:])
+    with multiprocessing.Pool(workers) as pool:
+        shards = [(data_path, start, end) for start, end in _byte_ranges(data_path, workers)]
+        sample_nums, pos_nums, max_dims = zip(*pool.map(_scan_shard, shards))
+    header = (sum(sample_nums), max(pos_nums), max(max_dims))
+    np.save(header_path, np.array((stat.st_size, stat.st_mtime_ns) + header, dtype=np.int64))
+    return header
+
+
+class PositionStreamDataset(PositionBatchBuilder, IterableDataset):
+    '''
+    Reads batches straight from the svm file without building a cache.
+    The file is cut into byte-range shards, DataLoader worker w of rank r parses every (world_size*num_workers)-th
+    shard, starting at r*num_workers + w, of a (seed, epoch)-shuffled shard order and shuffles samples within a buffer of shuffle_buffer contexts.
+    Yields the same PositionBatch as PositionDataset.get_batch, use it with DataLoader(batch_size=None).
+    '''
+    def __init__(self, dataset_path=None, data_prefix='tr', batch_size=1, tr_max_dim=-1, read_flag=0, shuffle=True, shuffle_buffer=100000, shard_size=int(6.4e7), seed=0, dedup_ctx=False, ragged_ctx=False, item_ids=False, scan_workers=-1):
+        '''
+        batch_size, shuffle: contexts per batch, shuffle shards and samples or read in file order
+        shuffle_buffer: contexts a worker holds for shuffling, 0 to shuffle shards only
+        shard_size: bytes per shard of the svm file
+        scan_workers: processes of the header pre-scan (sample_num, pos_num, max_dim), -1 for all cpus
+        other options, see PositionDataset
+        '''
+        self.data_path = os.path.join(dataset_path, data_prefix + '.svm')
+        assert Path(self.data_path).exists(), "%s does not exist!"%self.data_path
+        self.batch_size = batch_size
+        self.tr_max_dim = tr_max_dim
+        self.read_flag = read_flag
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.dedup_ctx = dedup_ctx
+        self.ragged_ctx = ragged_ctx
+        self.item_ids = item_ids
+        self.rng, self.rng_pid = None, None
+        self.epoch = 0
+        self.rank, self.world_size = 0, 1  # distributed training, set by the caller
+
+        print('Scanning %s.'%(self.data_path))
+        self.length, self.pos_num, max_dim = _scan_svm(self.data_path, scan_workers if scan_workers > 0 else os.cpu_count())
+        self.max_dim = max_dim + 1  # idx from 0 to max_dim_in_svmfile, 0 for padding
+        item_array = _read_items(os.path.join(dataset_path, 'item.svm'))
+        self.item_num, self.max_item_num = item_array.shape
+        self.items = item_array.astype(np.long)
+        self.item_set = np.arange(self.item_num, dtype=np.int32)
+        self.shards = _byte_ranges(self.data_path, max(1, -(-os.path.getsize(self.data_path)//shard_size)))
+        print('Totally %d items, %d dims, %d positions, %d samples'%(self.item_num, self.max_dim, self.pos_num, self.length))
+
+    def set_epoch(self, epoch):
+        '''
+        shard and sample order of the next iteration, call it before every epoch when num_workers > 0
+        '''
+        self.epoch = epoch
+
+    def __records(self, shards):
+        for start, end in shards:
+            for line in _iter_lines(self.data_path, start, end):
+                yield _parse_line(line)
+
+    def __shuffled(self, records, rng):
+        buf = list()
+        for record in records:
+            if len(buf) < self.shuffle_buffer:
+                buf.append(record)
+                continue
+            i = rng.randint(len(buf))
+            yield buf[i]
+            buf[i] = record
+        rng.shuffle(buf)
+        yield from buf
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        worker_id, num_workers = self.rank*num_workers + worker_id, self.world_size*num_workers
+        rng = np.random.RandomState([self.seed, self.epoch, worker_id])
+        shards = self.shards
+        if self.shuffle:
+            shards = [shards[i] for i in np.random.RandomState([self.seed, self.epoch]).permutation(len(shards))]
+        records = self.__records(shards[worker_id::num_workers])
+        if self.shuffle and self.shuffle_buffer > 0:
+            records = self.__shuffled(records, rng)
+        self.rng, self.rng_pid = np.random.default_rng([self.seed, self.epoch, worker_id]), os.getpid()
+        self.epoch += 1  # in-process iteration, workers get a copy
+        batch = list()
+        for record in records:
+            batch.append(record)
+            if len(batch) == self.batch_size:
+                yield self._make_batch(*_records_to_block(batch))
+                batch = list()
+        if batch:
+            yield self._make_batch(*_records_to_block(batch))
+
+    def get_max_dim(self):
+        return self.max_dim
+
+    def get_item_num(self):
+        return self.item_num
+
 if __name__ == '__main__':
     #@profile
     #def collate_fn_for_dssm(batch):
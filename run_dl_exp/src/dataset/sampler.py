@@ -0,0 +1,29 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class BlockShuffleSampler(Sampler):
+    '''
+    Shuffle the order of contiguous blocks of block_size samples, then shuffle the samples inside a buffer of
+    buffer_blocks consecutive blocks of that order. Cache reads stay within a few contiguous ranges at a time,
+    so they are mostly sequential for both the lmdb and the mmap cache.
+    Every iteration (epoch) draws a new order from (seed, epoch).
+    '''
+    def __init__(self, data_source, block_size=4096, buffer_blocks=16, seed=0):
+        self.length = len(data_source)
+        self.block_size = block_size
+        self.buffer_blocks = buffer_blocks
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        rng = np.random.RandomState([self.seed, self.epoch])
+        self.epoch += 1
+        blocks = rng.permutation(-(-self.length//self.block_size))
+        for i in range(0, len(blocks), self.buffer_blocks):
+            buf = np.concatenate([np.arange(b*self.block_size, min((b + 1)*self.block_size, self.length)) for b in blocks[i:i+self.buffer_blocks]])
+            rng.shuffle(buf)
+            yield from buf.tolist()
+
+    def __len__(self):
+        return self.length
@@ -0,0 +1,43 @@
+import torch
+import torch.distributed as dist
+
+
+class StreamingMetrics(object):
+    '''
+    Running logloss and fixed-bin AUC over batches of (prediction, target) tensors, kept on their device.
+    Memory is O(bins) whatever the number of samples. Predictions falling into the same bin count as ties,
+    so the AUC error is at most the share of positive/negative pairs sharing a bin (about 1/bins for smooth scores).
+    logloss is exact, with predictions clipped to [eps, 1-eps] as sklearn does.
+    '''
+    def __init__(self, device, bins=1<<20, eps=1e-15):
+        self.bins = bins
+        self.eps = eps
+        self.pos = torch.zeros(bins, dtype=torch.float64, device=device)
+        self.neg = torch.zeros(bins, dtype=torch.float64, device=device)
+        self.loss = torch.zeros(1, dtype=torch.float64, device=device)
+
+    def update(self, y, target):
+        y, target = y.detach().flatten().to(torch.float64), target.flatten().to(torch.float64)
+        p = y.clamp(self.eps, 1 - self.eps)
+        self.loss -= (target*p.log() + (1 - target)*(1 - p).log()).sum()
+        idx = (y*self.bins).long().clamp_(0, self.bins - 1)
+        self.pos += torch.bincount(idx, weights=target, minlength=self.bins)
+        self.neg += torch.bincount(idx, weights=1 - target, minlength=self.bins)
+
+    def all_reduce(self):
+        '''
+        sum the accumulators of every rank, gloo reduces them on cpu
+        '''
+        for name in ('pos', 'neg', 'loss'):
+            t = getattr(self, name).cpu()
+            dist.all_reduce(t)
+            setattr(self, name, t)
+
+    def compute(self):
+        '''
+        return (auc, logloss)
+        '''
+        pos_num, neg_num = self.pos.sum(), self.neg.sum()
+        pos_below = torch.cumsum(self.pos, 0) - self.pos  # positives in lower bins
+        auc = (self.neg*(pos_num - pos_below - self.pos) + 0.5*self.neg*self.pos).sum()/(pos_num*neg_num)
+        return auc.item(), (self.loss/(pos_num + neg_num)).item()
@@ -15,20 +15,26 @@ class DSSM(torch.nn.Module):
         self.t2_fc2 = torch.nn.Linear(embed_dim, embed_dim, bias=True)  # add 1 for padding_idx
         #self.t2_fc3 = torch.nn.Linear(100, 32, bias=True)  # add 1 for padding_idx
 
-    def forward(self, x1, x2, x3, use_relu=False):
+    def forward(self, x1, x2, x3, use_relu=False, ctx_offsets=None):
         if use_relu:
             act = torch.relu
         else:
             act = torch.tanh
         ## Tower 1
-        x1 = torch.sum(torch.mul(self.embed(x1), x3.unsqueeze(2)), dim = 1) + self.t1_bias1
+        if ctx_offsets is not None:  # ragged context: flat x1 and x3, one bag per offset
+            x1 = F.embedding_bag(x1, self.embed.weight, ctx_offsets, mode='sum', per_sample_weights=x3) + self.t1_bias1
+        else:
+            x1 = torch.sum(torch.mul(self.embed(x1), x3.unsqueeze(2)), dim = 1) + self.t1_bias1
         x1 = act(x1)
         x1 = self.t1_fc2(x1) 
         x1 = act(x1)
         #x1 = self.t1_fc3(x1) 
         #x1 = act(x1)
         ## Tower 2 
-        x2 = torch.sum(self.embed(x2), dim = 1) + self.t2_bias1
+        if ctx_offsets is not None:
+            x2 = F.embedding_bag(x2, self.embed.weight, mode='sum', per_sample_weights=(x2 != 0).to(self.embed.weight.dtype)) + self.t2_bias1
+        else:
+            x2 = torch.sum(self.embed(x2), dim = 1) + self.t2_bias1
         x2 = act(x2)
         x2 = self.t2_fc2(x2) 
         x2 = act(x2)
@@ -19,21 +19,27 @@ class ExtDSSM(torch.nn.Module):
         self.embed2 = torch.nn.Embedding(posSize+1, 1, padding_idx=0)  # trans one-hot vector to 300 dimensions
 
 
-    def forward(self, x1, x2, x3, x4, use_relu=False):
+    def forward(self, x1, x2, x3, x4, use_relu=False, ctx_offsets=None):
         if use_relu:
             act = torch.relu
         else:
             act = torch.tanh
         ## Tower 1
         #x1 = torch.sum(self.embed(x1), dim = 1) + self.t1_bias1
-        x1 = torch.sum(torch.mul(self.embed(x1), x4.unsqueeze(2)), dim = 1) + self.t1_bias1
+        if ctx_offsets is not None:  # ragged context: flat x1 and x4, one bag per offset
+            x1 = F.embedding_bag(x1, self.embed.weight, ctx_offsets, mode='sum', per_sample_weights=x4) + self.t1_bias1
+        else:
+            x1 = torch.sum(torch.mul(self.embed(x1), x4.unsqueeze(2)), dim = 1) + self.t1_bias1
         x1 = act(x1)
         x1 = self.t1_fc2(x1) 
         x1 = act(x1)
         #x1 = self.t1_fc3(x1) 
         #x1 = act(x1)
         ## Tower 2 
-        x2 = torch.sum(self.embed(x2), dim = 1) + self.t2_bias1
+        if ctx_offsets is not None:
+            x2 = F.embedding_bag(x2, self.embed.weight, mode='sum', per_sample_weights=(x2 != 0).to(self.embed.weight.dtype)) + self.t2_bias1
+        else:
+            x2 = torch.sum(self.embed(x2), dim = 1) + self.t2_bias1
         x2 = act(x2)
         x2 = self.t2_fc2(x2) 
         x2 = act(x2)
@@ -1,23 +1,58 @@
 import torch
 import torch.nn.functional as F
 
+from src.model.layer import bag_dot
+
 class ExtFFM(torch.nn.Module):
-    def __init__(self, inputSize, posSize, embed_dim):
+    def __init__(self, inputSize, posSize, embed_dim, items=None, sparse=False, fused=False):
         super().__init__()
-        self.embed1 = torch.nn.Embedding(inputSize, embed_dim, padding_idx=0)  
+        self.embed1 = torch.nn.Embedding(inputSize, embed_dim, padding_idx=0, sparse=sparse)  
 
         ## Pos
         self.embed2 = torch.nn.Embedding(posSize+1, 1, padding_idx=0)  # set position 0th as padding idx, real position starts from 1 to 10
+        self.fused = fused  # bag_dot interaction, no (batch_size, nnz, embed_dim) intermediates
+        if items is not None:  # item features of every item id, x2 can then be item ids
+            self.register_buffer('items', torch.as_tensor(items, dtype=torch.long))
         torch.nn.init.xavier_uniform_(self.embed1.weight.data[1:, :])
         torch.nn.init.xavier_uniform_(self.embed2.weight.data[1:, :])
 
 
-    def forward(self, x1, x2, x3, x4):  # x1: context, x2: item, x3: position
-        x1 = torch.sum(torch.mul(self.embed1(x1), x4.unsqueeze(2)), dim=1)  # field 1 embedding for cxt: (batch_size, cxt_nonzero_feature_num, embed_dim)
-        x2 = torch.sum(self.embed1(x2), dim=1)  # field 1 embedding for item: (batch_size, item_nonzero_feature_num, embed_dim)
+    def embed_context(self, x1, x4, ctx_offsets=None):  # (context_num, embed_dim)
+        if ctx_offsets is not None:  # ragged context: flat x1 and x4, one bag per offset, no padding lookups
+            return F.embedding_bag(x1, self.embed1.weight, ctx_offsets, mode='sum', sparse=self.embed1.sparse, per_sample_weights=x4)
+        return torch.sum(torch.mul(self.embed1(x1), x4.unsqueeze(2)), dim=1)  # field 1 embedding for cxt: (batch_size, cxt_nonzero_feature_num, embed_dim)
+
+    def embed_item(self, x2, bag=False):  # (item_num, embed_dim), x2: item feature rows or item ids
+        if x2.dim() == 1:  # item ids
+            x2 = self.items.index_select(0, x2)
+        if bag:  # item features as bags too, padding idx 0 weighted out so it gets no gradient
+            return F.embedding_bag(x2, self.embed1.weight, mode='sum', sparse=self.embed1.sparse, per_sample_weights=(x2 != 0).to(self.embed1.weight.dtype))
+        return torch.sum(self.embed1(x2), dim=1)  # field 1 embedding for item: (batch_size, item_nonzero_feature_num, embed_dim)
+
+    def position_logit(self, x3):
+        return torch.sum(self.embed2(x3), dim = 1)
 
-        ## merge
-        x12 = torch.sum(x1*x2, dim=1)  # (batch_size,)
-        x3 = torch.sum(self.embed2(x3), dim = 1)
+    def combine(self, x12, x3):  # x12: relevance logits, x3: position logits
         out = torch.sigmoid(x12 + x3)
         return out
+
+    def output(self, x12, x3):  # x12: context-item logits, x3: positions broadcastable to x12
+        return self.combine(x12, self.position_logit(x3))
+
+    def logits(self, x1, x2, x3, x4, ctx_rows=None, ctx_offsets=None):  # x1: context, x2: item, x3: position
+        '''
+        (relevance logits, position logits), combine() of them is forward(), combine() with the position
+        logits of position 0 is the without-position prediction
+        '''
+        if getattr(self, 'fused', False):  # models saved before the flag existed are not fused
+            if x2.dim() == 1:  # item ids
+                x2 = self.items.index_select(0, x2)
+            return bag_dot(self.embed1.weight, x1, x4, x2, ctx_rows, ctx_offsets, self.embed1.sparse), self.position_logit(x3)
+        x1 = self.embed_context(x1, x4, ctx_offsets)
+        if ctx_rows is not None:  # x1 holds each context once, broadcast it to its rows
+            x1 = x1.index_select(0, ctx_rows)
+        x2 = self.embed_item(x2, ctx_offsets is not None)
+        return torch.sum(x1*x2, dim=1), self.position_logit(x3)  # (batch_size,)
+
+    def forward(self, x1, x2, x3, x4, ctx_rows=None, ctx_offsets=None):  # x1: context, x2: item, x3: position
+        return self.combine(*self.logits(x1, x2, x3, x4, ctx_rows, ctx_offsets))
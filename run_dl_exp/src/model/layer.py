@@ -63,12 +63,42 @@ class MultiLayerPerceptron(torch.nn.Module):
         return self.mlp(x)
 
 
+class _CrossConv(torch.autograd.Function):
+    """
+    The 1x1 Conv1d (no bias) of the CIN outer product, out[b,o,d] = sum_{f,g} W[o,f,g] x0[b,f,d] h[b,g,d],
+    computed field_chunk fields of x0 at a time: no (batch_size, f0, fin, embed_dim) tensor is built and
+    the backward recomputes the chunks from x0, h and W instead of saving them
+    """
+    @staticmethod
+    def forward(ctx, x0, h, weight, field_chunk):
+        ctx.save_for_backward(x0, h, weight)
+        ctx.field_chunk = field_chunk
+        out = x0.new_zeros(x0.shape[0], weight.shape[0], x0.shape[2])
+        for s in range(0, x0.shape[1], field_chunk):
+            u = torch.einsum('ocg,bgd->bocd', weight[:, s:s+field_chunk], h)  # W h per x0 field of the chunk
+            out += torch.sum(u*x0[:, s:s+field_chunk].unsqueeze(1), dim=2)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad):
+        x0, h, weight = ctx.saved_tensors
+        grad_x0, grad_h, grad_weight = torch.empty_like(x0), torch.zeros_like(h), torch.empty_like(weight)
+        for s in range(0, x0.shape[1], ctx.field_chunk):
+            w = weight[:, s:s+ctx.field_chunk]
+            gx = grad.unsqueeze(2)*x0[:, s:s+ctx.field_chunk].unsqueeze(1)  # (batch_size, out, chunk, embed_dim)
+            grad_weight[:, s:s+ctx.field_chunk] = torch.einsum('bocd,bgd->ocg', gx, h)
+            grad_h += torch.einsum('ocg,bocd->bgd', w, gx)
+            grad_x0[:, s:s+ctx.field_chunk] = torch.sum(grad.unsqueeze(2)*torch.einsum('ocg,bgd->bocd', w, h), dim=1)
+        return grad_x0, grad_h, grad_weight, None
+
+
 class CompressedInteractionNetwork(torch.nn.Module):
 
-    def __init__(self, input_dim, cross_layer_sizes, split_half=True):
+    def __init__(self, input_dim, cross_layer_sizes, split_half=True, field_chunk=1):
         super().__init__()
         self.num_layers = len(cross_layer_sizes)
         self.split_half = split_half
+        self.field_chunk = field_chunk  # x0 fields per step of the cross product, memory grows with it
         self.conv_layers = torch.nn.ModuleList()
         prev_dim, fc_input_dim = input_dim, 0
         for cross_layer_size in cross_layer_sizes:
@@ -85,13 +115,13 @@ class CompressedInteractionNetwork(torch.nn.Module):
         :param x: Float tensor of size ``(batch_size, num_fields, embed_dim)``
         """
         xs = list()
-        x0, h = x.unsqueeze(2), x
-        #print(x0.size(), h.size())
+        x0, h = x, x
+        field_chunk = getattr(self, 'field_chunk', 1)  # models saved before field_chunk existed
         for i in range(self.num_layers):
-            x = x0 * h.unsqueeze(1)
-            batch_size, f0_dim, fin_dim, embed_dim = x.shape
-            x = x.view(batch_size, f0_dim * fin_dim, embed_dim)
-            x = F.relu(self.conv_layers[i](x))
+            conv = self.conv_layers[i]
+            # conv(x0 * h) with the (f0 * fin) conv channels as a (out, f0, fin) weight
+            weight = conv.weight.view(conv.out_channels, x0.shape[1], h.shape[1])
+            x = F.relu(_CrossConv.apply(x0, h, weight, field_chunk) + conv.bias.unsqueeze(1))
             if self.split_half: #and i != self.num_layers - 1:
                 x, h = torch.split(x, x.shape[1] // 2, dim=1)
             else:
@@ -146,24 +176,93 @@ class FieldAwareFactorizationMachine(torch.nn.Module):
     def __init__(self, field_dims, embed_dim):
         super().__init__()
         self.num_fields = len(field_dims)
-        self.embeddings = torch.nn.ModuleList([
-            torch.nn.Embedding(sum(field_dims), embed_dim) for _ in range(self.num_fields)
-        ])
+        self.embed_dim = embed_dim
+        # one table, row r holds the num_fields embeddings of feature r, one per field it interacts with
+        self.embedding = torch.nn.Embedding(sum(field_dims), self.num_fields * embed_dim)
         self.offsets = np.array((0, *np.cumsum(field_dims)[:-1]), dtype=np.long)
-        for embedding in self.embeddings:
-            torch.nn.init.xavier_uniform_(embedding.weight.data)
+        rows, cols = np.triu_indices(self.num_fields, 1)  # the field pairs (i, j), i < j, in the order of the pair loop
+        self.register_buffer('rows', torch.as_tensor(rows, dtype=torch.long))
+        self.register_buffer('cols', torch.as_tensor(cols, dtype=torch.long))
+        weight = self.embedding.weight.data.view(-1, self.num_fields, embed_dim)
+        for i in range(self.num_fields):  # xavier bounds of a (sum(field_dims), embed_dim) table per field
+            torch.nn.init.xavier_uniform_(weight[:, i])
 
     def forward(self, x):
         """
         :param x: Long tensor of size ``(batch_size, num_fields)``
+        :output: Float tensor of size ``(batch_size, num_fields*(num_fields-1)/2, embed_dim)``
         """
         x = x + x.new_tensor(self.offsets).unsqueeze(0)
-        xs = [self.embeddings[i](x) for i in range(self.num_fields)]  # (num_fields, feature_num, embed_dim)
-        ix = list()
-        for i in range(self.num_fields - 1):
-            for j in range(i + 1, self.num_fields):
-                ix.append(xs[j][:, i] * xs[i][:, j])  # [filed jth, :, embed_dim ith] 
-        ix = torch.stack(ix, dim=1)
-        return ix
+        x = self.embedding(x).view(x.shape[0], self.num_fields, self.num_fields, self.embed_dim)  # [feature of field i, for field j]
+        return x[:, self.rows, self.cols] * x[:, self.cols, self.rows]  # field j embedding of i * field i embedding of j
+
+
+def _flat_bags(idx, weights=None):
+    """
+    :param idx: Long tensor of size ``(bag_num, nnz)``, 0 is padding
+    :param weights: Float tensor of size ``(bag_num, nnz)``, None weighs every feature 1
+    :output: the non-padding indices, their weights and the length of every bag, padding is never looked up
+    """
+    mask = idx != 0
+    return idx[mask], None if weights is None else weights[mask], mask.sum(dim=1)
+
+
+class _BagDot(torch.autograd.Function):
+    """
+    sum(bag(ctx) * bag(item), dim=1) with weighted bag-sums, the backward writes one gradient row per looked up
+    feature (a sparse COO gradient if sparse) instead of going through (batch_size, nnz, embed_dim) tensors
+    """
+    @staticmethod
+    def forward(ctx, weight, ctx_idx, ctx_w, ctx_len, item_idx, item_w, item_len, ctx_rows, sparse):
+        ctx_offsets = torch.cumsum(ctx_len, 0) - ctx_len
+        item_offsets = torch.cumsum(item_len, 0) - item_len
+        c = F.embedding_bag(ctx_idx, weight, ctx_offsets, mode='sum', per_sample_weights=ctx_w)  # (context_num, embed_dim)
+        i = F.embedding_bag(item_idx, weight, item_offsets, mode='sum', per_sample_weights=item_w)  # (batch_size, embed_dim)
+        ctx.save_for_backward(ctx_idx, ctx_w, ctx_len, item_idx, item_w, item_len, ctx_rows, c, i)
+        ctx.weight_shape, ctx.sparse = weight.shape, sparse
+        if ctx_rows is not None:
+            c = c.index_select(0, ctx_rows)
+        return torch.sum(c*i, dim=1)
+
+    @staticmethod
+    def backward(ctx, grad):
+        ctx_idx, ctx_w, ctx_len, item_idx, item_w, item_len, ctx_rows, c, i = ctx.saved_tensors
+        grad = grad.unsqueeze(1)
+        grad_c = grad*i  # (batch_size, embed_dim)
+        if ctx_rows is not None:  # sum the rows of every context back into it
+            grad_i = grad*c.index_select(0, ctx_rows)
+            grad_c = c.new_zeros(c.shape).index_add_(0, ctx_rows, grad_c)
+        else:
+            grad_i = grad*c
+        ctx_bag = torch.arange(ctx_len.shape[0], device=ctx_len.device).repeat_interleave(ctx_len)
+        item_bag = torch.arange(item_len.shape[0], device=item_len.device).repeat_interleave(item_len)
+        rows = torch.cat((ctx_idx, item_idx))
+        values = torch.cat((grad_c.index_select(0, ctx_bag)*ctx_w.unsqueeze(1), grad_i.index_select(0, item_bag)*item_w.unsqueeze(1)))
+        if ctx.sparse:
+            grad_weight = torch.sparse_coo_tensor(rows.unsqueeze(0), values, ctx.weight_shape)
+        else:
+            grad_weight = values.new_zeros(ctx.weight_shape).index_add_(0, rows, values)
+        return grad_weight, None, None, None, None, None, None, None, None
 
 
+def bag_dot(weight, ctx_idx, ctx_value, item_idx, ctx_rows=None, ctx_offsets=None, sparse=False):
+    """
+    The FFM interaction of a shared embedding table, equal to
+    ``torch.sum(torch.sum(E[ctx_idx]*ctx_value, 1)[ctx_rows] * torch.sum(E[item_idx], 1), dim=1)``
+    with padding idx 0 looked up nowhere and getting no gradient.
+    :param weight: Float tensor of size ``(input_dims, embed_dim)``
+    :param ctx_idx, ctx_value: Long / Float tensors of size ``(context_num, nnz)``, or flat with ctx_offsets
+    :param item_idx: Long tensor of size ``(batch_size, item_nnz)``
+    :param ctx_rows: Long tensor of size ``(batch_size,)``, the context of every row, None if one context per row
+    :param sparse: return a sparse gradient for weight, as Embedding(sparse=True) does
+    :output: Float tensor of size ``(batch_size,)``
+    """
+    if ctx_offsets is None:
+        ctx_idx, ctx_w, ctx_len = _flat_bags(ctx_idx, ctx_value)
+    else:
+        ctx_w = ctx_value
+        ctx_len = torch.cat((ctx_offsets[1:], ctx_offsets.new_tensor([ctx_idx.shape[0]]))) - ctx_offsets
+    item_idx, _, item_len = _flat_bags(item_idx)
+    ctx_w = ctx_w.to(weight.dtype)
+    item_w = weight.new_ones(item_idx.shape[0])
+    return _BagDot.apply(weight, ctx_idx, ctx_w, ctx_len, item_idx, item_w, item_len, ctx_rows, sparse)
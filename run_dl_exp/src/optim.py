@@ -0,0 +1,109 @@
+import math
+import torch
+
+
+class LazyAdam(torch.optim.Optimizer):
+    '''
+    Adam that accepts both dense and sparse gradients.
+    Dense gradients get the same update as torch.optim.Adam (L2 weight_decay added to the gradient).
+    Sparse gradients (Embedding(sparse=True), embedding_bag(sparse=True)) only update the moments and the
+    weights of the rows in the batch, weight_decay is applied to those rows only.
+    '''
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0):
+        if lr < 0.0:
+            raise ValueError('Invalid learning rate: {}'.format(lr))
+        if not 0.0 <= betas[0] < 1.0 or not 0.0 <= betas[1] < 1.0:
+            raise ValueError('Invalid beta parameters: {}'.format(betas))
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super().__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
+                state['step'] += 1
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                step_size = group['lr']*math.sqrt(1 - beta2**state['step'])/(1 - beta1**state['step'])
+
+                if p.grad.is_sparse:
+                    grad = p.grad.coalesce()  # one value per touched row
+                    rows, values = grad._indices()[0], grad._values()
+                    if rows.numel() == 0:
+                        continue
+                    if group['weight_decay'] != 0:
+                        values = values + group['weight_decay']*p.index_select(0, rows)
+                    row_avg = exp_avg.index_select(0, rows).mul_(beta1).add_(values, alpha=1 - beta1)
+                    row_avg_sq = exp_avg_sq.index_select(0, rows).mul_(beta2).addcmul_(values, values, value=1 - beta2)
+                    exp_avg.index_copy_(0, rows, row_avg)
+                    exp_avg_sq.index_copy_(0, rows, row_avg_sq)
+                    p.index_add_(0, rows, row_avg.div_(row_avg_sq.sqrt_().add_(group['eps'])).mul_(-step_size))
+                else:
+                    grad = p.grad
+                    if group['weight_decay'] != 0:
+                        grad = grad.add(p, alpha=group['weight_decay'])
+                    exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                    exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                    p.addcdiv_(exp_avg, exp_avg_sq.sqrt().add_(group['eps']), value=-step_size)
+        return loss
+
+
+class LazyAdagrad(torch.optim.Optimizer):
+    '''
+    Adagrad that accepts both dense and sparse gradients, weight_decay is applied to the rows in the batch only
+    for sparse ones. The accumulators are created up front, so share_memory() can put them in shared memory and
+    hogwild workers update one model and one set of accumulators without locks, as hybrid-ocffm does.
+    '''
+    def __init__(self, params, lr=1e-2, weight_decay=0, initial_accumulator_value=0, eps=1e-10):
+        if lr < 0.0:
+            raise ValueError('Invalid learning rate: {}'.format(lr))
+        defaults = dict(lr=lr, weight_decay=weight_decay, eps=eps)
+        super().__init__(params, defaults)
+        for group in self.param_groups:
+            for p in group['params']:
+                self.state[p]['sum'] = torch.full_like(p, initial_accumulator_value)
+
+    def share_memory(self):
+        for group in self.param_groups:
+            for p in group['params']:
+                self.state[p]['sum'].share_memory_()
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad_sum = self.state[p]['sum']
+                if p.grad.is_sparse:
+                    grad = p.grad.coalesce()  # one value per touched row
+                    rows, values = grad._indices()[0], grad._values()
+                    if rows.numel() == 0:
+                        continue
+                    if group['weight_decay'] != 0:
+                        values = values + group['weight_decay']*p.index_select(0, rows)
+                    grad_sum.index_add_(0, rows, values*values)
+                    std = grad_sum.index_select(0, rows).sqrt_().add_(group['eps'])
+                    p.index_add_(0, rows, values.div(std).mul_(-group['lr']))
+                else:
+                    grad = p.grad
+                    if group['weight_decay'] != 0:
+                        grad = grad.add(p, alpha=group['weight_decay'])
+                    grad_sum.addcmul_(grad, grad, value=1)
+                    p.addcdiv_(grad, grad_sum.sqrt().add_(group['eps']), value=-group['lr'])
+        return loss
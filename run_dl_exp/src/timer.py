@@ -0,0 +1,80 @@
+import time
+import resource
+import contextlib
+import torch
+
+
+class StageTimer(object):
+    '''
+    Wall time per training stage (data, h2d, forward, backward, step, metrics), samples/sec and peak RSS.
+    On cuda every stage synchronizes the device, so kernels are charged to the stage that launched them.
+    profile_window=(start, end): trace steps [start, end) of the first epoch to trace_path (chrome trace format).
+    A disabled timer only counts samples, its stages are no-ops.
+    '''
+    def __init__(self, device, enabled=True, profile_window=None, trace_path=None):
+        self.cuda = device.type == 'cuda'
+        self.sync = enabled and self.cuda
+        self.enabled = enabled
+        self.profile_window = profile_window
+        self.trace_path = trace_path
+        self.prof = None
+        self.reset()
+
+    def reset(self):
+        self.seconds = dict()
+        self.samples = 0
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.time()
+        yield
+        if self.sync:
+            torch.cuda.synchronize()
+        self.seconds[name] = self.seconds.get(name, 0.) + time.time() - start
+
+    def add_samples(self, n):
+        self.samples += n
+
+    def step(self, i):
+        '''
+        call before step i of the loop, starts and stops the profiler at the window bounds
+        '''
+        if self.profile_window is None:
+            return
+        start, end = self.profile_window
+        if i == start:
+            self.prof = self.__profiler()
+            self.prof.__enter__()
+        elif i == end:
+            self.stop_profile()
+
+    def stop_profile(self):
+        if self.prof is not None:
+            self.prof.__exit__(None, None, None)
+            self.prof.export_chrome_trace(self.trace_path)
+            print('Profiler trace saved to %s.'%self.trace_path)
+            self.prof = None
+            self.profile_window = None  # trace once
+
+    def __profiler(self):
+        if hasattr(torch, 'profiler') and hasattr(torch.profiler, 'profile'):  # torch >= 1.8
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            return torch.profiler.profile(activities=activities, record_shapes=True)
+        return torch.autograd.profiler.profile(use_cuda=self.cuda)
+
+    def summary(self):
+        sec = time.time() - self.start
+        summary = {'seconds': sec, 'samples': self.samples, 'samples_per_sec': self.samples/sec if sec > 0 else 0.}
+        summary.update({'%s_seconds'%k: v for k, v in sorted(self.seconds.items())})
+        # ru_maxrss is in KB on linux, children are the DataLoader workers that have exited
+        summary['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+        summary['peak_rss_children_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024
+        return summary